@@ -1,32 +1,45 @@
+import functools
 import json
-from typing import Optional
-from .models import ProductWithSimilarity
+from typing import TYPE_CHECKING, Optional
+from .models import SearchFilters, SearchResult
 import logging
 import os
-from azure.cosmos import exceptions, CosmosClient, PartitionKey, ContainerProxy
-from azure.identity import DefaultAzureCredential
+from timing import span
+from embeddings import EMBEDDING_DIMENSIONS, IMAGE_EMBEDDING_DIMENSIONS
+from .cosmos_settings import DEFAULT_DATABASE_NAME, DEFAULT_CONTAINER_NAME, DESCRIPTION_EMBEDDING_FIELD, IMAGE_EMBEDDING_FIELD
 
-cosmos_url = os.getenv("AZURE_COSMOS_URL")
-if not cosmos_url:
-    logging.error("AZURE_COSMOS_URL is not set")
-    raise ValueError("AZURE_COSMOS_URL is not set")
+if TYPE_CHECKING:
+    from azure.cosmos import CosmosClient, ContainerProxy
 
-cosmos_key = os.getenv("AZURE_COSMOS_KEY", None)
+DEFAULT_LIMIT = 10
 
-DEFAULT_DATABASE_NAME = "products"
-DEFAULT_CONTAINER_NAME = "products"
+# The size of each vector field, for the vector_embedding_policy and to check the query embeddings
+EMBEDDING_FIELD_DIMENSIONS = {
+    IMAGE_EMBEDDING_FIELD: IMAGE_EMBEDDING_DIMENSIONS,
+    DESCRIPTION_EMBEDDING_FIELD: EMBEDDING_DIMENSIONS,
+}
+
+
+@functools.cache
+def get_client() -> "CosmosClient":
+    """
+    Create the Cosmos client on first use, so importing this module doesn't import the Cosmos and Identity SDKs
+    """
+    from azure.cosmos import CosmosClient
 
-DESCRIPTION_EMBEDDING_FIELD = "productDescriptionVector"
-IMAGE_EMBEDDING_FIELD = "productImageVector"
+    cosmos_url = os.getenv("AZURE_COSMOS_URL")
+    if not cosmos_url:
+        logging.error("AZURE_COSMOS_URL is not set")
+        raise ValueError("AZURE_COSMOS_URL is not set")
 
-client: CosmosClient
+    cosmos_key = os.getenv("AZURE_COSMOS_KEY", None)
+    if not cosmos_key:
+        # assume managed identity
+        from azure.identity import DefaultAzureCredential
 
-if not cosmos_key:
-    # assume managed identity
-    credential = DefaultAzureCredential()
-    client = CosmosClient(cosmos_url, credential)
-else:
-    client = CosmosClient(cosmos_url, cosmos_key)
+        credential = DefaultAzureCredential()
+        return CosmosClient(cosmos_url, credential)
+    return CosmosClient(cosmos_url, cosmos_key)
 
 
 vector_embedding_policy = { 
@@ -35,13 +48,13 @@ vector_embedding_policy = {
             "path": f"/{IMAGE_EMBEDDING_FIELD}", 
             "dataType": "float32", 
             "distanceFunction": "cosine", 
-            "dimensions": 1024
+            "dimensions": EMBEDDING_FIELD_DIMENSIONS[IMAGE_EMBEDDING_FIELD]
         }, 
         { 
             "path": f"/{DESCRIPTION_EMBEDDING_FIELD}", 
             "dataType": "float32", 
             "distanceFunction": "cosine", 
-            "dimensions": 1024
+            "dimensions": EMBEDDING_FIELD_DIMENSIONS[DESCRIPTION_EMBEDDING_FIELD]
         } 
     ]    
 }
@@ -63,87 +76,143 @@ indexing_policy = {
 
 id_affix = "product-"
 
+_checked_vector_policy = False
+
+
+def check_vector_policy(container: "ContainerProxy"):
+    """
+    Warn (once) if the container was created with different vector dimensions, e.g. before EMBEDDING_DIMENSIONS
+    was changed. The vector policy of an existing container can't be changed, so create_container_if_not_exists keeps it.
+    """
+    global _checked_vector_policy
+    if _checked_vector_policy:
+        return
+    _checked_vector_policy = True
+    policy = container.read().get("vectorEmbeddingPolicy") or {}
+    for embedding in policy.get("vectorEmbeddings", []):
+        field = embedding["path"].lstrip("/")
+        expected = EMBEDDING_FIELD_DIMENSIONS.get(field)
+        if expected is not None and embedding.get("dimensions") != expected:
+            logging.warning(f"The {field} vector policy of the container has {embedding.get('dimensions')} dimensions, "
+                            f"but the embeddings have {expected}. Recreate the container to change it.")
+
 def get_container(
     database: str = DEFAULT_DATABASE_NAME, container_name: str = DEFAULT_CONTAINER_NAME
-) -> ContainerProxy:
+) -> "ContainerProxy":
+    from azure.cosmos import exceptions, PartitionKey
+
     try:
-        database = client.create_database_if_not_exists(database)
+        database = get_client().create_database_if_not_exists(database)
         container = database.create_container_if_not_exists(
             id=container_name,
             partition_key=PartitionKey(path="/id"),
             indexing_policy=indexing_policy,
             vector_embedding_policy=vector_embedding_policy,
         )
+        check_vector_policy(container)
         return container
     except exceptions.CosmosResourceNotFoundError:
         logging.error("Database or container not found")
         return None
 
 
-def vector_search(container: ContainerProxy, embedding: list[float], embedding_field: str, top: Optional[int] = 5) -> list[ProductWithSimilarity]:
-    results: list[ProductWithSimilarity] = []
-    
+def filter_clause(filters: Optional[SearchFilters]) -> tuple[str, list[dict]]:
+    """
+    Turn the filters into a Cosmos SQL condition (to AND with the rest of the WHERE clause) and its parameters
+    """
+    conditions = ["true"]
+    parameters = []
+    if filters and filters.min_price is not None:
+        conditions.append("c.price >= @min_price")
+        parameters.append({"name": "@min_price", "value": filters.min_price})
+    if filters and filters.max_price is not None:
+        conditions.append("c.price <= @max_price")
+        parameters.append({"name": "@max_price", "value": filters.max_price})
+    return " AND ".join(conditions), parameters
+
+
+def vector_search(container: "ContainerProxy", embedding: list[float], embedding_field: str,
+                  limit: int = DEFAULT_LIMIT, offset: int = 0, filters: Optional[SearchFilters] = None) -> list[SearchResult]:
+    if len(embedding) != EMBEDDING_FIELD_DIMENSIONS[embedding_field]:
+        raise ValueError(f"The query embedding has {len(embedding)} dimensions, but {embedding_field} has {EMBEDDING_FIELD_DIMENSIONS[embedding_field]}")
+    results: list[SearchResult] = []
+    condition, parameters = filter_clause(filters)
+
+    # The filters and the paging are done by the vector search in Cosmos, not afterwards
     for item in container.query_items( 
-        query=f'SELECT TOP {top} c.id, c.name, c.description, c.image, c.price, VectorDistance(c.{embedding_field},@embedding) AS SimilarityScore FROM c ORDER BY VectorDistance(c.{embedding_field},@embedding)', 
+        query=f'SELECT c.id, c.name, c.description, c.image, c.price, VectorDistance(c.{embedding_field},@embedding) AS SimilarityScore FROM c WHERE {condition} ORDER BY VectorDistance(c.{embedding_field},@embedding) OFFSET @offset LIMIT @limit', 
         parameters=[ 
-            {"name": "@embedding", "value": embedding} 
+            {"name": "@embedding", "value": embedding},
+            {"name": "@offset", "value": offset},
+            {"name": "@limit", "value": limit},
+            *parameters
         ], 
         enable_cross_partition_query=True):
-        results.append(ProductWithSimilarity(
+        results.append(SearchResult(
             id=int(item['id'].replace(id_affix, "")),
             name=item['name'],
             description=item['description'],
             image=item['image'],
             price=item['price'],
-            embedding=None,
             similarity=item['SimilarityScore']
         ))
     return results
 
 
-def search_images(embedding: list[float]) -> list[ProductWithSimilarity]:
-    container = get_container()
+def search_images(embedding: list[float], limit: int = DEFAULT_LIMIT, offset: int = 0, filters: Optional[SearchFilters] = None) -> list[SearchResult]:
+    with span("get_container"):
+        container = get_container()
     if not container:
         return []
     
-    return vector_search(container, embedding, IMAGE_EMBEDDING_FIELD)
+    with span("vector_search"):
+        return vector_search(container, embedding, IMAGE_EMBEDDING_FIELD, limit, offset, filters)
 
 
 def search_products(
-    query: str, fts_query: str, embedding: list[float]
-) -> list[ProductWithSimilarity]:
-    container = get_container()
+    query: str, fts_query: str, embedding: list[float],
+    limit: int = DEFAULT_LIMIT, offset: int = 0, filters: Optional[SearchFilters] = None
+) -> list[SearchResult]:
+    with span("get_container"):
+        container = get_container()
     if not container:
         return []
 
+    condition, parameters = filter_clause(filters)
     results = []
-    # 1. Search for products using the FTS query
-    for item in container.query_items( 
-        query='SELECT c.id, c.name, c.description, c.image, c.price FROM c WHERE CONTAINS(c.name, @query) OR CONTAINS(c.description, @query)', 
-        parameters=[ 
-            {"name": "@query", "value": fts_query} 
-        ], 
-        enable_cross_partition_query=True):
-        results.append(ProductWithSimilarity(
-            id=int(item['id'].replace(id_affix, "")),
-            name=item['name'],
-            description=item['description'],
-            image=item['image'],
-            price=item['price'],
-            embedding=None,
-            similarity=1.0
-        ))
-
-    # 2. Search for products using the vector search
-    vector_results = vector_search(container, embedding, DESCRIPTION_EMBEDDING_FIELD)
-
-    found_ids = [product.id for product in results]
+    # 1. Search for products using the FTS query.
+    # Keyword matches come first, so at most offset + limit of them can be on this page or before it.
+    # They are ordered by id, so every page sees the same ones (a cross-partition query has no order otherwise)
+    with span("keyword_search"):
+        for item in container.query_items( 
+            query=f'SELECT c.id, c.name, c.description, c.image, c.price FROM c WHERE (CONTAINS(c.name, @query) OR CONTAINS(c.description, @query)) AND {condition} ORDER BY c.id OFFSET 0 LIMIT @limit', 
+            parameters=[ 
+                {"name": "@query", "value": fts_query},
+                {"name": "@limit", "value": offset + limit},
+                *parameters
+            ], 
+            enable_cross_partition_query=True):
+            results.append(SearchResult(
+                id=int(item['id'].replace(id_affix, "")),
+                name=item['name'],
+                description=item['description'],
+                image=item['image'],
+                price=item['price'],
+                similarity=1.0
+            ))
+
+    # 2. Search for products using the vector search.
+    # Some of the vector hits may be keyword matches too, so fetch enough to fill the page after removing those
+    with span("vector_search"):
+        vector_results = vector_search(container, embedding, DESCRIPTION_EMBEDDING_FIELD, offset + limit + len(results), 0, filters)
+
+    found_ids = {product.id for product in results}
 
     for product in vector_results:
         if product.id not in found_ids:
             results.append(product)
     
-    return results
+    return results[offset:offset + limit]
 
 
 def seed_test_data():
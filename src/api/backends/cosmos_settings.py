@@ -0,0 +1,12 @@
+"""
+The Cosmos DB names that function_app.py needs to declare the Cosmos DB trigger.
+
+They are in their own module, with no imports, so that loading the function app doesn't import
+the Cosmos backend (and with it pydantic and the models) before the first request.
+"""
+
+DEFAULT_DATABASE_NAME = "products"
+DEFAULT_CONTAINER_NAME = "products"
+
+DESCRIPTION_EMBEDDING_FIELD = "productDescriptionVector"
+IMAGE_EMBEDDING_FIELD = "productImageVector"
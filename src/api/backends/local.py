@@ -5,53 +5,98 @@ It uses sqlite and FTS5 (if available) for search.
 It also uses numpy for vector similarity, BUT because SQLite doesn't do vector 
 indexes it has to calculate the similarity for every product in the database.
 
-This means the search is very slow and O(N^N), but it's good enough for development purposes.
+The embeddings are loaded into an in-memory VectorIndex the first time they are needed, so
+each search is one matrix-vector product, but it is still a scan of every (matching) product.
+
+The database is a file (dev.db, or LOCAL_DATABASE) in WAL mode. Searches borrow a read-only
+connection from a pool shared by the worker threads, see sqlite_pool.py.
 """
 
 import sqlite3 
+import atexit
+import functools
 import json
 import logging
-from typing import Optional
-import numpy as np
-from .models import ProductWithSimilarity
+import os
+import threading
+import time
+from contextlib import ExitStack, closing, contextmanager
+from typing import Iterator, Optional
+from embeddings import EMBEDDING_DIMENSIONS, IMAGE_EMBEDDING_DIMENSIONS
+from timing import span
+from .models import SearchFilters, SearchResult
+from .sharded_index import ShardedVectorIndex
+from .sqlite_pool import ConnectionPool
+from .vector_index import VectorIndex
 
-HAS_FTS5 = False
+DATABASE = os.getenv("LOCAL_DATABASE", "dev.db")
+TEST_DATA = "data/test.json"
 SIMILARITY_THRESHOLD = 0.2
+DEFAULT_LIMIT = 10
 
+# Two-stage (Matryoshka) search, see vector_index.py. Scan this many leading dimensions of each embedding, then
+# re-rank the best matches with the full embedding. 0 scans the full embeddings. Only the text-embedding-3 (text)
+# embeddings are trained for this, the Computer Vision (image) embeddings lose a lot more when truncated.
+COARSE_DIMENSIONS = {
+    "embedding": int(os.getenv("LOCAL_TEXT_COARSE_DIMENSIONS", 0)),
+    "image_embedding": int(os.getenv("LOCAL_IMAGE_COARSE_DIMENSIONS", 0)),
+}
 
-def cosine_similarity(a: list[float], b: list[float]) -> float:
-    """
-    Calculate the cosine similarity between two vectors
-    """
-    a = np.array(a)
-    b = np.array(b)
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+# The dimensions the query embeddings will have, the stored embeddings are checked against these
+EMBEDDING_FIELD_DIMENSIONS = {
+    "embedding": EMBEDDING_DIMENSIONS,
+    "image_embedding": IMAGE_EMBEDDING_DIMENSIONS,
+}
+
+# Set to 2 or more to search the vector indexes with this many worker processes (see sharded_index.py)
+VECTOR_SHARDS = int(os.getenv("LOCAL_VECTOR_SHARDS", 0))
+# Wait until the catalog has stopped changing for this long before rebuilding the sharded indexes
+SHARD_REBUILD_DELAY = float(os.getenv("LOCAL_SHARD_REBUILD_DELAY", 5))
+# How many product changes to keep for the other processes to catch up with
+CHANGE_LOG_SIZE = 10000
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+# Vector indexes by embedding field, built on first use
+_indexes: dict[str, VectorIndex] = {}
+# The catalog version (see catalog_version) each index is up to date with
+_index_versions: dict[str, int] = {}
+_index_lock = threading.Lock()
 
+# Sharded copies of the vector indexes, by embedding field, and the fields being (re)built
+_sharded: dict[str, ShardedVectorIndex] = {}
+_sharding: set[str] = set()
+_shard_lock = threading.Lock()
 
-def connect(database = 'dev.db') -> "sqlite3.Connection":
+
+@functools.cache
+def has_fts5() -> bool:
     """
-    Setup the development database
+    Whether this build of SQLite has the FTS5 extension
     """
-    global HAS_FTS5
-    HAS_TABLES = False
-    conn = sqlite3.connect(database)
+    with closing(sqlite3.connect(':memory:')) as conn:
+        return any(option == "ENABLE_FTS5" for option, in conn.execute("PRAGMA compile_options"))
+
+
+def to_csv(embedding: Optional[list[float]]) -> str:
+    return ','.join([str(f) for f in embedding or []])
 
-    # If the products table exists, return the connection
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='products';")
-    if cursor.fetchone():
-        logging.info("Database already exists")
 
-        # does the table have data?
-        cursor.execute("SELECT * FROM products")
-        if cursor.fetchone():
-            logging.info("Database has data")
-            return conn
-        HAS_TABLES = True
+def connect(database: str = DATABASE) -> "sqlite3.Connection":
+    """
+    Setup the development database and return a connection for writing to it (in autocommit mode)
+    """
+    conn = sqlite3.connect(database, check_same_thread=False, isolation_level=None)
+    # WAL lets the pooled readers carry on while something is writing
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
 
-    # Create a products table with the columns id, name, description, image, price and embedding
-    if not HAS_TABLES:
-        conn.execute("""create table products (
+    # Several workers may start at once, only one of them should create and load the database
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Create a products table with the columns id, name, description, image, price and embedding
+        conn.execute("""create table if not exists products (
                         id integer primary key,
                         name text,
                         description text,
@@ -60,79 +105,423 @@ def connect(database = 'dev.db') -> "sqlite3.Connection":
                         embedding text,
                         image_embedding text
                      );""")
-        logging.info("Created products table")
-        
-        if HAS_FTS5:
-            # Create a FTS5 virtual table for full-text search
-            conn.execute("""create virtual table productFtsIndex using fts5(name, description, content='products', content_rowid='id');""")
-            logging.info("Created products vtable index")
-
-    # Load the test data from ../data/test.json
-    with open('data/test.json') as f:
-        data = json.load(f)
-        for product in data:
-            conn.execute("INSERT INTO products (name, description, image, price, embedding, image_embedding) VALUES (?, ?, ?, ?, ?, ?)", 
-                         (product['name'], 
-                          product['description'], 
-                          product['image'], 
-                          product['price'], 
-                          # Convert the embedding into a string of CSV values, this is hugely inefficient but we have 9 products
-                          ','.join([str(f) for f in product.get('embedding', [])]),
-                          ','.join([str(f) for f in product.get('image_embedding', [])]),
-                          ))
-        logging.info("Loaded test data into database")
+
+        needs_fts_rebuild = False
+        if has_fts5():
+            if not conn.execute("SELECT name FROM sqlite_master WHERE name='productFtsIndex'").fetchone():
+                # Create a FTS5 virtual table for full-text search
+                conn.execute("""create virtual table productFtsIndex using fts5(name, description, content='products', content_rowid='id');""")
+                logging.info("Created products vtable index")
+                needs_fts_rebuild = True
+
+            # Keep the FTS index in step with the products table
+            conn.execute("""create trigger if not exists productsFtsInsert after insert on products begin
+                                insert into productFtsIndex(rowid, name, description) values (new.id, new.name, new.description);
+                            end;""")
+            conn.execute("""create trigger if not exists productsFtsDelete after delete on products begin
+                                insert into productFtsIndex(productFtsIndex, rowid, name, description) values ('delete', old.id, old.name, old.description);
+                            end;""")
+            conn.execute("""create trigger if not exists productsFtsUpdate after update on products begin
+                                insert into productFtsIndex(productFtsIndex, rowid, name, description) values ('delete', old.id, old.name, old.description);
+                                insert into productFtsIndex(rowid, name, description) values (new.id, new.name, new.description);
+                            end;""")
+
+        # Every change to the products is logged, so other processes using the same database can bring their
+        # vector indexes up to date (see get_index). The version of the catalog is the last entry.
+        conn.execute("create table if not exists productChanges (version integer primary key autoincrement, product_id integer);")
+        conn.execute("""create trigger if not exists productsChangeInsert after insert on products begin
+                            insert into productChanges(product_id) values (new.id);
+                        end;""")
+        conn.execute("""create trigger if not exists productsChangeDelete after delete on products begin
+                            insert into productChanges(product_id) values (old.id);
+                        end;""")
+        conn.execute("""create trigger if not exists productsChangeUpdate after update on products begin
+                            insert into productChanges(product_id) values (old.id);
+                            insert into productChanges(product_id) select new.id where new.id != old.id;
+                        end;""")
+
+        # Keep track of which version of data/test.json was loaded
+        conn.execute("create table if not exists catalogInfo (key text primary key, value);")
+        load_test_data(conn)
+
+        if needs_fts_rebuild:
+            # Index any products that were added before the FTS table existed
+            conn.execute("INSERT INTO productFtsIndex(productFtsIndex) VALUES ('rebuild')")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
 
     return conn
 
 
-def vector_search_products(cursor, embedding: list[float], embedding_field: Optional[str] = "embedding") -> list[ProductWithSimilarity]:
-    # Do a vector search. This is sqlite and we don't have a vector index, so do a similarity on ALL of them
-    cursor.execute(f"SELECT id, name, description, price, image, {embedding_field} FROM products");
-    results = cursor.fetchall()
-    distances: tuple[float, tuple[int, str, str, str]] = []
-    for result in results:
-        # Calculate the cosine similarity between the embeddings
-        similarity = cosine_similarity(embedding, [float(a) for a in result[5].split(',')])
+def load_test_data(conn: sqlite3.Connection):
+    """
+    (Re)load the products from data/test.json if it has changed since it was last loaded, replacing the products in
+    the database. Products added with upsert_product are kept until then. Call inside a write transaction.
+    """
+    has_data = conn.execute("SELECT id FROM products LIMIT 1").fetchone() is not None
+    if has_data and not os.path.exists(TEST_DATA):
+        logging.info("Database has data")
+        return
+    modified = os.stat(TEST_DATA).st_mtime_ns
+    loaded = conn.execute("SELECT value FROM catalogInfo WHERE key = 'test_data_modified'").fetchone()
+    if has_data and loaded and loaded[0] == modified:
+        logging.info("Database has data")
+        return
 
-        # A crude cutoff filter. 
-        if similarity > SIMILARITY_THRESHOLD:
-            distances.append((similarity, tuple(result[0:5])))
-    
-    # Sort the results by similarity, descending.
-    distances = sorted(distances, key=lambda x: x[0], reverse=True)
+    with open(TEST_DATA) as f:
+        data = json.load(f)
+    conn.execute("DELETE FROM products")
+    for product in data:
+        conn.execute("INSERT INTO products (id, name, description, image, price, embedding, image_embedding) VALUES (?, ?, ?, ?, ?, ?, ?)", 
+                     (product.get('id'),
+                      product['name'], 
+                      product['description'], 
+                      product['image'], 
+                      product['price'], 
+                      # Convert the embedding into a string of CSV values, this is hugely inefficient but we have 9 products
+                      to_csv(product.get('embedding')),
+                      to_csv(product.get('image_embedding')),
+                      ))
+    conn.execute("INSERT OR REPLACE INTO catalogInfo (key, value) VALUES ('test_data_modified', ?)", (modified,))
+    prune_changes(conn)
+    logging.info(f"Loaded test data into database ({'it has changed since it was loaded' if has_data else 'it was empty'})")
 
-    logging.info(f"Found {len(distances)} results with similarity > {SIMILARITY_THRESHOLD}")
 
-    return [ProductWithSimilarity(id=product[0], name=product[1], description=product[2], price=product[3], image=product[4], embedding=None, similarity=similarity) for similarity, product in distances]
+def get_pool() -> ConnectionPool:
+    """
+    The connection pool for the database, created (and the database set up) on first use
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(DATABASE, connect(DATABASE))
+    return _pool
 
 
-def search_images(embedding: list[float]):
-    cursor = connect(':memory:').cursor()
-    return vector_search_products(cursor, embedding, 'image_embedding')
+@contextmanager
+def reader() -> Iterator[sqlite3.Connection]:
+    """
+    Borrow a pooled read-only connection. Setting up the database (on first use) and the checkout are timed as
+    the connect stage, the queries are timed by the caller.
+    """
+    with ExitStack() as stack:
+        with span("connect"):
+            conn = stack.enter_context(get_pool().reader())
+        yield conn
 
 
-def search_products(query: str, fts_query: str, embedding: list[float]) -> list[ProductWithSimilarity]:
-    cursor = connect(':memory:').cursor()
+def catalog_version(cursor) -> int:
+    return cursor.execute("SELECT coalesce(max(version), 0) FROM productChanges").fetchone()[0]
 
-    vector_results = vector_search_products(cursor, embedding)
 
-    # Search the productFtsIndex table for the query
-    if HAS_FTS5:
-        cursor.execute("SELECT id, name, description, price, image FROM productFtsIndex WHERE productFtsIndex MATCH ?", (fts_query,))
-    else:
-        cursor.execute("SELECT id, name, description, price, image FROM products WHERE name LIKE ? OR description LIKE ?", ('%'+query+'%', '%'+query+'%'))
-    fts_results = cursor.fetchall()
-    logging.info(f"Found {len(fts_results)} results from FTS5")
+def prune_changes(conn: sqlite3.Connection):
+    """
+    Only keep the last CHANGE_LOG_SIZE changes. A process that is further behind than that rebuilds its indexes.
+    """
+    conn.execute("DELETE FROM productChanges WHERE version <= (SELECT max(version) FROM productChanges) - ?", (CHANGE_LOG_SIZE,))
+
+
+def parse_embedding(embedding: Optional[str]) -> Optional[list[float]]:
+    return [float(value) for value in embedding.split(',')] if embedding else None
+
+
+def get_index(cursor, embedding_field: str = "embedding") -> VectorIndex:
+    """
+    The vector index for the field, built on first use. If another process has changed the products since, the
+    changed products are applied to the index first.
+    """
+    index = _indexes.get(embedding_field)
+    if index is not None and _index_versions.get(embedding_field) == catalog_version(cursor):
+        return index
+    with _index_lock:
+        index = _indexes.get(embedding_field)
+        # Read the version and the products in one transaction, so they agree
+        cursor.execute("BEGIN")
+        try:
+            version = catalog_version(cursor)
+            if index is not None and not catch_up(cursor, index, embedding_field, version):
+                index = None
+            if index is None:
+                cursor.execute(f"SELECT id, price, {embedding_field} FROM products")
+                index = _indexes[embedding_field] = VectorIndex.from_rows(cursor.fetchall(), COARSE_DIMENSIONS.get(embedding_field, 0))
+                logging.info(f"Built vector index for {embedding_field} with {len(index)} products"
+                             f" and {index.dimensions} dimensions ({index.coarse_dimensions or 'no'} coarse dimensions)")
+                expected = EMBEDDING_FIELD_DIMENSIONS.get(embedding_field)
+                if len(index) and index.dimensions != expected:
+                    logging.warning(f"The stored {embedding_field}s have {index.dimensions} dimensions, but the query embeddings "
+                                    f"will have {expected}, so searches will fail. Re-seed the embeddings, or for the text embeddings change EMBEDDING_DIMENSIONS.")
+            _index_versions[embedding_field] = version
+        finally:
+            cursor.execute("COMMIT")
+    return index
+
+
+def catch_up(cursor, index: VectorIndex, embedding_field: str, version: int) -> bool:
+    """
+    Apply the products changed (by any process) since the index was last brought up to date. Returns False if the
+    changes are no longer in the log, or there are so many the index should be rebuilt instead.
+    """
+    since = _index_versions.get(embedding_field, 0)
+    if version == since:
+        return True
+    oldest = cursor.execute("SELECT min(version) FROM productChanges").fetchone()[0]
+    if oldest is None or oldest > since + 1:
+        return False
+    changed = [product_id for product_id, in cursor.execute("SELECT DISTINCT product_id FROM productChanges WHERE version > ? AND version <= ?", (since, version))]
+    if len(changed) > len(index) // 2:
+        return False
+    cursor.execute(f"SELECT id, price, {embedding_field} FROM products WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(changed),))
+    products = {product_id: (price, embedding) for product_id, price, embedding in cursor.fetchall()}
+    for product_id in changed:
+        if product_id in products:
+            price, embedding = products[product_id]
+            index.upsert(product_id, parse_embedding(embedding), price)
+        else:
+            index.delete(product_id)
+    logging.info(f"Applied {len(changed)} changed products to the {embedding_field} index")
+    return True
+
+
+def get_searcher(cursor, embedding_field: str = "embedding") -> VectorIndex | ShardedVectorIndex:
+    """
+    The sharded index for the field if sharding is on and it is up to date, otherwise the VectorIndex
+    """
+    index = get_index(cursor, embedding_field)
+    if VECTOR_SHARDS < 2:
+        return index
+    sharded = _sharded.get(embedding_field)
+    if sharded is not None and sharded.is_current(index):
+        return sharded
+    with _shard_lock:
+        if embedding_field not in _sharding:
+            _sharding.add(embedding_field)
+            threading.Thread(target=_build_sharded, args=(index, embedding_field, sharded is not None),
+                             name=f"shard-{embedding_field}", daemon=True).start()
+    return index
+
+
+def _build_sharded(index: VectorIndex, embedding_field: str, wait: bool):
+    try:
+        # The out of date copy isn't used any more, close it now rather than having three copies of the catalog
+        # (it, the VectorIndex and the new one) in memory while the new one is built
+        previous = _sharded.pop(embedding_field, None)
+        if previous is not None:
+            previous.close()
+        if wait:
+            # Catalog updates tend to come in bursts, only rebuild once they stop
+            version = None
+            while version != index.version:
+                version = index.version
+                time.sleep(SHARD_REBUILD_DELAY)
+        _sharded[embedding_field] = ShardedVectorIndex(index, VECTOR_SHARDS)
+    except Exception:
+        logging.exception(f"Failed to build the sharded index for {embedding_field}")
+    finally:
+        with _shard_lock:
+            _sharding.discard(embedding_field)
 
-    # Combine the results from the FTS5 search and the vector search
-    # We use a dict to get keep the results unique and ordered
-    results = [ProductWithSimilarity(id=product[0], name=product[1], description=product[2], price=product[3], image=product[4], embedding=None, similarity=1) for product in fts_results]
 
-    found_ids = [product.id for product in results]
+@atexit.register
+def _close_sharded():
+    for sharded in _sharded.values():
+        sharded.close()
+
+
+def search_vectors(cursor, embedding: list[float], k: int, embedding_field: str = "embedding",
+                   filters: Optional[SearchFilters] = None) -> list[tuple[int, float]]:
+    searcher = get_searcher(cursor, embedding_field)
+    if isinstance(searcher, ShardedVectorIndex):
+        try:
+            return searcher.search(embedding, k, filters, SIMILARITY_THRESHOLD)
+        except Exception as e:
+            # e.g. it was replaced (and shut down) during the search, or a worker process died
+            logging.warning(f"Sharded search failed ({e!r}), searching in process")
+    return get_index(cursor, embedding_field).search(embedding, k, filters, SIMILARITY_THRESHOLD)
+
+
+def warm_up():
+    """
+    Load the catalog and build the vector indexes ahead of the first search
+    """
+    with get_pool().reader() as conn:
+        cursor = conn.cursor()
+        get_searcher(cursor, "embedding")
+        get_searcher(cursor, "image_embedding")
+    if any(COARSE_DIMENSIONS.values()):
+        recall_report()
+
+
+def recall_report(k: int = 10, sample: int = 100) -> dict[str, dict]:
+    """
+    How much the two-stage search costs in recall for each embedding field, compared to a full scan
+    """
+    report = {}
+    with get_pool().reader() as conn:
+        cursor = conn.cursor()
+        for embedding_field in COARSE_DIMENSIONS:
+            index = get_index(cursor, embedding_field)
+            report[embedding_field] = {
+                "dimensions": index.dimensions,
+                "coarse_dimensions": index.coarse_dimensions,
+                f"recall@{k}": index.recall(k=k, sample=sample) if index.coarse_dimensions else 1.0,
+            }
+            logging.info(f"Vector index {embedding_field}: {report[embedding_field]}")
+    return report
+
+
+def upsert_product(product: dict) -> int:
+    """
+    Add or update a product, in the same format as data/test.json. If the product has no id, a new one is assigned.
+    Updates the database, the FTS index and the vector indexes, without rebuilding any of them. Returns the product id.
+    Other processes using the database apply the change to their vector indexes on their next search.
+    """
+    # Hold the index lock, so an index that is being built can't miss the change
+    with _index_lock:
+        with get_pool().writer() as conn:
+            before = catalog_version(conn)
+            cursor = conn.execute("""INSERT INTO products (id, name, description, image, price, embedding, image_embedding) VALUES (?, ?, ?, ?, ?, ?, ?)
+                                     ON CONFLICT (id) DO UPDATE SET name = excluded.name, description = excluded.description, image = excluded.image,
+                                        price = excluded.price, embedding = excluded.embedding, image_embedding = excluded.image_embedding""",
+                                  (product.get('id'),
+                                   product['name'],
+                                   product['description'],
+                                   product['image'],
+                                   product['price'],
+                                   to_csv(product.get('embedding')),
+                                   to_csv(product.get('image_embedding')),
+                                   ))
+            product_id = product.get('id') or cursor.lastrowid
+            after = catalog_version(conn)
+            prune_changes(conn)
+        for field, index in _indexes.items():
+            # If the index is behind (another process changed the products), the next search catches it up, this change included
+            if _index_versions.get(field) == before:
+                index.upsert(product_id, product.get(field), product['price'])
+                _index_versions[field] = after
+    logging.info(f"Upserted product {product_id}")
+    return product_id
+
+
+def delete_product(product_id: int):
+    """
+    Delete a product from the database, the FTS index and the vector indexes
+    """
+    with _index_lock:
+        with get_pool().writer() as conn:
+            before = catalog_version(conn)
+            conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+            after = catalog_version(conn)
+            prune_changes(conn)
+        for field, index in _indexes.items():
+            if _index_versions.get(field) == before:
+                index.delete(product_id)
+                _index_versions[field] = after
+    logging.info(f"Deleted product {product_id}")
+
+
+def price_clause(filters: Optional[SearchFilters], column: str = "price") -> tuple[str, list]:
+    """
+    Turn the filters into a SQL condition (to AND with the rest of the WHERE clause) and its parameters
+    """
+    conditions = ["1"]
+    params = []
+    if filters and filters.min_price is not None:
+        conditions.append(f"{column} >= ?")
+        params.append(filters.min_price)
+    if filters and filters.max_price is not None:
+        conditions.append(f"{column} <= ?")
+        params.append(filters.max_price)
+    return " AND ".join(conditions), params
+
+
+def fetch_products(cursor, hits: list[tuple[int, float]]) -> list[SearchResult]:
+    """
+    Load the products for a list of (id, similarity) hits, keeping the order of the hits
+    """
+    if not hits:
+        return []
+    # Pass the ids as one JSON array, so the SQL text (and the prepared statement) is the same for every page size
+    ids = json.dumps([product_id for product_id, _ in hits])
+    cursor.execute("SELECT id, name, description, price, image FROM products WHERE id IN (SELECT value FROM json_each(?))", (ids,))
+    products = {product[0]: product for product in cursor.fetchall()}
+    results = []
+    for product_id, similarity in hits:
+        product = products.get(product_id)
+        if product:
+            results.append(SearchResult(id=product[0], name=product[1], description=product[2], price=product[3], image=product[4], similarity=similarity))
+    return results
+
+
+def vector_search_products(cursor, embedding: list[float], embedding_field: Optional[str] = "embedding",
+                           limit: int = DEFAULT_LIMIT, offset: int = 0, filters: Optional[SearchFilters] = None) -> list[SearchResult]:
+    # The filters are applied before the similarity scan and only the top offset + limit hits are ranked
+    with span("vector_search"):
+        hits = search_vectors(cursor, embedding, offset + limit, embedding_field, filters)[offset:]
+
+    logging.info(f"Found {len(hits)} results with similarity > {SIMILARITY_THRESHOLD}")
+
+    with span("fetch_products"):
+        return fetch_products(cursor, hits)
+
+
+def keyword_search_products(cursor, query: str, fts_query: str, limit: int, filters: Optional[SearchFilters] = None) -> list[tuple]:
+    """
+    The first `limit` keyword matches, best FTS5 rank first. The order must be stable for the paging to work.
+    """
+    condition, params = price_clause(filters, "products.price")
+    if has_fts5():
+        try:
+            cursor.execute(f"""SELECT products.id, products.name, products.description, products.price, products.image
+                               FROM productFtsIndex JOIN products ON products.id = productFtsIndex.rowid
+                               WHERE productFtsIndex MATCH ? AND {condition}
+                               ORDER BY productFtsIndex.rank, products.id LIMIT ?""", (fts_query, *params, limit))
+            return cursor.fetchall()
+        except sqlite3.OperationalError as e:
+            # The query comes from the LLM, and isn't always valid FTS5 syntax
+            logging.warning(f"FTS5 query {fts_query!r} failed ({e}), using LIKE instead")
+    cursor.execute(f"SELECT id, name, description, price, image FROM products WHERE (name LIKE ? OR description LIKE ?) AND {condition} ORDER BY id LIMIT ?",
+                       ('%'+query+'%', '%'+query+'%', *params, limit))
+    return cursor.fetchall()
+
+
+def search_images(embedding: list[float], limit: int = DEFAULT_LIMIT, offset: int = 0, filters: Optional[SearchFilters] = None) -> list[SearchResult]:
+    with reader() as conn:
+        return vector_search_products(conn.cursor(), embedding, 'image_embedding', limit, offset, filters)
+
+
+def search_products(query: str, fts_query: str, embedding: list[float],
+                    limit: int = DEFAULT_LIMIT, offset: int = 0, filters: Optional[SearchFilters] = None) -> list[SearchResult]:
+    with reader() as conn:
+        return _search_products(conn.cursor(), query, fts_query, embedding, limit, offset, filters)
+
+
+def _search_products(cursor, query: str, fts_query: str, embedding: list[float],
+                     limit: int, offset: int, filters: Optional[SearchFilters]) -> list[SearchResult]:
+    # Keyword matches come first, so at most offset + limit of them can be on this page or before it
+    with span("keyword_search"):
+        fts_results = keyword_search_products(cursor, query, fts_query, offset + limit, filters)
+    logging.info(f"Found {len(fts_results)} results from FTS5")
+
+    # Some of the vector hits may be keyword matches too, so fetch enough to fill the page after removing those
+    with span("vector_search"):
+        hits = search_vectors(cursor, embedding, offset + limit + len(fts_results), "embedding", filters)
 
-    for product in vector_results:
-        if product.id not in found_ids:
-            results.append(product)
+    # Combine the results from the FTS5 search and the vector search, keeping them unique and ordered
+    found_ids = {product[0] for product in fts_results}
+    ranked = [(product[0], 1.0) for product in fts_results] + [hit for hit in hits if hit[0] not in found_ids]
+    page = ranked[offset:offset + limit]
 
-    return list(results)[:10]
-    
\ No newline at end of file
+    # Only the products on the requested page are loaded
+    fts_page = {product[0]: product for product in fts_results}
+    with span("fetch_products"):
+        vector_page = {product.id: product for product in fetch_products(cursor, [hit for hit in page if hit[0] not in fts_page])}
+    results = []
+    for product_id, _ in page:
+        if product_id in fts_page:
+            product = fts_page[product_id]
+            results.append(SearchResult(id=product[0], name=product[1], description=product[2], price=product[3], image=product[4], similarity=1.0))
+        elif product_id in vector_page:
+            results.append(vector_page[product_id])
+    return results
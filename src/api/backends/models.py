@@ -1,4 +1,8 @@
-from pydantic import BaseModel
+import functools
+from dataclasses import dataclass
+from typing_extensions import TypedDict
+
+from pydantic import BaseModel, TypeAdapter
 
 
 class Product(BaseModel):
@@ -13,5 +17,46 @@ class Product(BaseModel):
         return hash(self.id)
 
 
-class ProductWithSimilarity(Product):
+@dataclass(slots=True)
+class SearchResult:
+    """
+    A search hit. This is a plain slotted dataclass rather than a pydantic model because the backends
+    create one for every candidate while ranking, and it doesn't need validation. It doesn't carry the
+    embedding, so it's also the wire format for the search responses.
+    """
+    id: int
+    name: str
+    description: str
+    image: str
+    price: float
     similarity: float
+
+
+@dataclass(slots=True)
+class SearchFilters:
+    """
+    Attribute predicates for a search. The backends apply these inside the search, not to the results.
+    """
+    min_price: float | None = None
+    max_price: float | None = None
+
+    def __bool__(self):
+        return self.min_price is not None or self.max_price is not None
+
+
+class SearchResponse(TypedDict):
+    keywords: str | None
+    results: list[SearchResult]
+
+
+@functools.cache
+def _search_response_adapter() -> TypeAdapter:
+    # Building the serializer takes a while, so do it on the first response rather than at import
+    return TypeAdapter(SearchResponse)
+
+
+def dump_search_response(keywords: str | None, results: list[SearchResult]) -> bytes:
+    """
+    Serialize a page of search results to JSON in one pass (pydantic-core, no per-item model_dump()).
+    """
+    return _search_response_adapter().dump_json({"keywords": keywords, "results": results})
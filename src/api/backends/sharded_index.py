@@ -0,0 +1,149 @@
+"""
+A multi-process version of VectorIndex.search for large catalogs.
+
+A single search in VectorIndex runs on one core. ShardedVectorIndex copies the live rows of a
+VectorIndex into shared memory (memory-mapped files, in /dev/shm where there is one) and starts a
+pool of worker processes that can all read it. The VectorIndex then uses the shared copy as its own
+(VectorIndex.adopt), so the catalog is only held in memory once. A query (or a batch of queries) is
+scattered to every shard, each shard returns its own top k (or with coarse dimensions, its
+shortlist), and the shard results are merged.
+
+The shared copy is a snapshot, it doesn't see upserts and deletes made to the VectorIndex after
+it was built. The local backend checks `is_current()`, closes the out of date copy and rebuilds it in
+the background when the catalog changes, using the VectorIndex until the new snapshot is ready.
+"""
+
+import logging
+import mmap
+import multiprocessing
+import os
+import tempfile
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import numpy as np
+from .models import SearchFilters
+from .vector_index import VectorIndex, price_mask, rank, rerank, search_rows, shortlist, two_stage
+
+# Where the shared arrays are kept. Files in /dev/shm are only ever in memory, elsewhere they are temporary files
+# that the processes share through the page cache.
+SHARED_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# The shared arrays, in each worker process
+_shared: dict[str, np.ndarray] = {}
+
+
+def _map(path: str, shape: tuple, dtype: np.dtype, writable: bool = False) -> np.ndarray:
+    """
+    Map a file as an array. The mapping stays valid after the file is closed (or deleted), until the array is freed.
+    """
+    with open(path, "r+b" if writable else "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+    return np.frombuffer(mapped, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _attach(arrays: dict[str, tuple[str, tuple, str]]):
+    """
+    Worker process initializer, map the shared arrays
+    """
+    for key, (path, shape, dtype) in arrays.items():
+        _shared[key] = _map(path, shape, np.dtype(dtype))
+
+
+def _search_shard(start: int, end: int, queries: np.ndarray, k: int, filters: Optional[SearchFilters], threshold: float) -> list[tuple]:
+    """
+    Search rows start:end for each (normalized) query. With coarse dimensions this returns each query's shortlist
+    (see vector_index.shortlist), for search_batch to re-rank with the other shards' shortlists. Otherwise it returns
+    the ids and similarities of the top k.
+    """
+    ids, vectors, coarse = _shared["ids"][start:end], _shared["vectors"][start:end], _shared["coarse"][start:end]
+    mask = price_mask(_shared["prices"][start:end], filters)
+    rows = None if mask is None else np.flatnonzero(mask)
+    if two_stage(coarse.shape[1], k):
+        return shortlist(ids, vectors, coarse, rows, queries)
+    return search_rows(ids, vectors, None, rows, queries, k, threshold)
+
+
+class ShardedVectorIndex:
+    def __init__(self, index: VectorIndex, shards: int):
+        # A rebuilt VectorIndex starts at version 0 again, so remember which index this is a copy of
+        self._source = weakref.ref(index)
+        self._files: dict[str, tuple[str, tuple, str]] = {}
+        arrays, self.version = index.export(self._allocate)
+        self.count, self.dimensions = arrays["vectors"].shape
+        self.coarse_dimensions = arrays["coarse"].shape[1]
+
+        bounds = np.linspace(0, self.count, shards + 1).astype(int)
+        self._shards = [(start, end) for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()) if end > start]
+        # spawn, not fork, the Functions worker has threads running
+        self._executor = ProcessPoolExecutor(
+            max_workers=shards,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_attach,
+            initargs=(self._files,),
+        )
+        if self.count:
+            # Start the worker processes now, rather than on the first search
+            self.search_batch(arrays["vectors"][:1].astype(np.float32), 1)
+        # The index can drop its own copy now, unless it changed while this one was being made
+        adopted = index.adopt(arrays, self.version)
+        logging.info(f"Built sharded vector index with {self.count} products in {len(self._shards)} shards"
+                     f"{'' if adopted else ', the index changed in the meantime'}")
+
+    def _allocate(self, name: str, shape: tuple, dtype: np.dtype) -> np.ndarray:
+        """
+        Create a shared (memory-mapped) array, see VectorIndex.export
+        """
+        fd, path = tempfile.mkstemp(prefix=f"vector-index-{name}-", dir=SHARED_DIRECTORY)
+        with os.fdopen(fd, "wb") as f:
+            # An empty file can't be mapped
+            f.truncate(max(int(np.prod(shape)) * dtype.itemsize, 1))
+        self._files[name] = (path, shape, dtype.str)
+        return _map(path, shape, dtype, writable=True)
+
+    def is_current(self, index: VectorIndex) -> bool:
+        return self._source() is index and self.version == index.version
+
+    def search_batch(self, embeddings: list[list[float]], k: int, filters: Optional[SearchFilters] = None,
+                     threshold: float = -1.0) -> list[list[tuple[int, float]]]:
+        """
+        Search for several embeddings at once. Returns the (id, similarity) of the top k for each, like VectorIndex.search
+        """
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        if queries.shape[1] != self.dimensions:
+            raise ValueError(f"The query embeddings have {queries.shape[1]} dimensions, but the index has {self.dimensions}")
+        if k <= 0 or not self._shards:
+            return [[] for _ in embeddings]
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        queries = queries / norms
+
+        # Scatter
+        futures = [self._executor.submit(_search_shard, start, end, queries, k, filters, threshold) for start, end in self._shards]
+        shard_results = [future.result() for future in futures]
+
+        # Gather: the same second stage as VectorIndex.search, over all of the shards' candidates
+        results = []
+        for query in range(len(queries)):
+            if two_stage(self.coarse_dimensions, k):
+                ids, scores = rerank([shard[query] for shard in shard_results], k, threshold)
+            else:
+                ids, scores = (np.concatenate(arrays) for arrays in zip(*(shard[query] for shard in shard_results)))
+                keep = rank(scores, k)
+                ids, scores = ids[keep], scores[keep]
+            results.append(list(zip(ids.tolist(), scores.tolist())))
+        return results
+
+    def search(self, embedding: list[float], k: int, filters: Optional[SearchFilters] = None, threshold: float = -1.0) -> list[tuple[int, float]]:
+        return self.search_batch([embedding], k, filters, threshold)[0]
+
+    def close(self):
+        # Let any searches that are already running finish
+        self._executor.shutdown(wait=True)
+        # The VectorIndex may still be using the arrays, its mappings stay valid after the files are deleted
+        for path, _, _ in self._files.values():
+            try:
+                os.remove(path)
+            except OSError as e:
+                # e.g. Windows doesn't allow deleting a file that is mapped
+                logging.warning(f"Failed to remove shared vector index file {path}: {e}")
@@ -0,0 +1,80 @@
+"""
+A small connection pool for a file-backed SQLite database, shared by the worker threads.
+
+The Functions Python worker runs sync functions on a thread pool (PYTHON_THREADPOOL_THREAD_COUNT),
+so requests can arrive on any thread at the same time. The database is in WAL mode, so there can be
+one writer and any number of readers at once without them blocking each other:
+
+- Reads use read-only (query_only) connections. Idle connections are kept in the pool and reused, along
+  with their prepared statement cache, so use the same SQL text for the same query.
+- Writes go through the single writer connection, one at a time, in a BEGIN IMMEDIATE transaction.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+DEFAULT_POOL_SIZE = int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT") or os.cpu_count() or 4)
+STATEMENT_CACHE_SIZE = 256
+
+
+class ConnectionPool:
+    def __init__(self, database: str, writer: sqlite3.Connection, size: int = DEFAULT_POOL_SIZE):
+        """
+        writer is an open connection to the database, in autocommit mode (isolation_level=None)
+        """
+        self.database = database
+        self.size = size
+        self._writer = writer
+        self._write_lock = threading.Lock()
+        # LIFO so the most recently used (warmest) connections are reused first
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+
+    def _open_reader(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.database, check_same_thread=False, isolation_level=None,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrow a read-only connection. More than `size` connections can be open at once, but only `size` are kept.
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open_reader()
+        try:
+            yield conn
+        finally:
+            if self._idle.qsize() < self.size:
+                self._idle.put(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """
+        Use the writer connection inside a transaction, committed when the block exits without an error
+        """
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._write_lock:
+            self._writer.close()
@@ -0,0 +1,408 @@
+"""
+An in-memory, brute-force vector index for the local backend.
+
+The embeddings are kept as one normalized float32 matrix, so a query is a single matrix-vector
+product instead of a python loop over the products. Attribute predicates (e.g. a price range) are
+applied as a mask *before* the scan, so only the matching rows are scored, and only the top
+`offset + limit` hits are sorted.
+
+The index can be updated in place. New and updated products are appended to the end of the
+arrays (which have spare capacity, like a list), and deleted or replaced rows are marked dead
+(a tombstone) rather than removed. Once enough rows are dead the arrays are compacted in a
+background thread. Searches read an immutable snapshot of the arrays, so they never wait for writes.
+
+With coarse_dimensions set, the index also keeps a copy of the first coarse_dimensions of every
+vector, re-normalized. The text-embedding-3 models are trained so that a prefix of an embedding is a
+usable (Matryoshka) embedding itself. A search scans the short vectors to pick a shortlist, then
+re-ranks the shortlist with the full vectors, which reads about coarse/full of the memory a full
+scan does. The full vectors are then only needed for the re-ranking, so they are stored as float16,
+which keeps the index smaller than float32 vectors alone (for coarse dimensions up to half of them). The shortlist is the same size whatever k is, so every page of the results is ranked from
+the same candidates. Use recall() to check how many of the exact results it still finds.
+"""
+
+import logging
+import threading
+from typing import Callable, NamedTuple, Optional
+import numpy as np
+from .models import SearchFilters
+
+# Compact once this fraction of the rows are tombstones
+COMPACT_RATIO = 0.25
+MIN_CAPACITY = 64
+# float16 vectors are converted to float32 this many rows at a time for scoring, rather than all at once
+SCORE_CHUNK = 16384
+# With coarse dimensions, re-rank this many candidates with the full vectors. The shortlist doesn't depend on k, so
+# every page of a search is ranked from the same candidates. It covers the deepest page of a hybrid search
+# (MAX_SEARCH_OFFSET + MAX_SEARCH_LIMIT in function_app.py, plus as many keyword matches), larger k are ranked exactly.
+SHORTLIST_SIZE = 2 * (1000 + 50)
+
+
+class _Snapshot(NamedTuple):
+    ids: np.ndarray
+    # float32, or float16 with coarse dimensions
+    vectors: np.ndarray
+    # The re-normalized prefixes of the vectors, no columns without coarse dimensions
+    coarse: np.ndarray
+    prices: np.ndarray
+    alive: np.ndarray
+    # The rows in use, the arrays have spare capacity after this
+    count: int
+
+
+def _normalize(vector) -> Optional[np.ndarray]:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector) if vector.size else 0
+    return vector / norm if norm else None
+
+
+def truncate(vectors: np.ndarray, dimensions: int) -> np.ndarray:
+    """
+    The first `dimensions` of each (row) vector, re-normalized
+    """
+    prefix = np.ascontiguousarray(vectors[..., :dimensions], dtype=np.float32)
+    norms = np.linalg.norm(prefix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return prefix / norms
+
+
+def vector_dtype(coarse_dimensions: int) -> type:
+    """
+    How the full vectors are stored, see above
+    """
+    return np.float16 if coarse_dimensions > 0 else np.float32
+
+
+def similarities(vectors: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    """
+    vectors @ queries.T in float32. float16 vectors are converted a chunk at a time, so a scan of all of them
+    doesn't make a float32 copy of the whole matrix.
+    """
+    if vectors.dtype == np.float32:
+        return vectors @ queries.T
+    scores = np.empty((len(vectors), len(queries)), dtype=np.float32)
+    for start in range(0, len(vectors), SCORE_CHUNK):
+        scores[start:start + SCORE_CHUNK] = vectors[start:start + SCORE_CHUNK].astype(np.float32) @ queries.T
+    return scores
+
+
+def rank(scores: np.ndarray, k: int, threshold: float = -np.inf) -> np.ndarray:
+    """
+    Positions of the k highest scores above threshold, highest first. Only the top k are sorted.
+    """
+    keep = np.flatnonzero(scores > threshold)
+    if len(keep) > k:
+        keep = keep[np.argpartition(scores[keep], -k)[-k:]]
+    return keep[np.argsort(scores[keep])[::-1]]
+
+
+def price_mask(prices: np.ndarray, filters: Optional[SearchFilters]) -> Optional[np.ndarray]:
+    """
+    Which of the prices pass the filters, or None if there are no filters
+    """
+    if not filters:
+        return None
+    mask = np.ones(len(prices), dtype=bool)
+    if filters.min_price is not None:
+        mask &= prices >= filters.min_price
+    if filters.max_price is not None:
+        mask &= prices <= filters.max_price
+    return mask
+
+
+def two_stage(coarse_dimensions: int, k: int) -> bool:
+    """
+    Whether a search for the top k uses the coarse vectors
+    """
+    return coarse_dimensions > 0 and k <= SHORTLIST_SIZE
+
+
+def shortlist(ids: np.ndarray, vectors: np.ndarray, coarse: np.ndarray, rows: Optional[np.ndarray],
+              queries: np.ndarray) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    The first stage of a two-stage search. For each of the normalized queries, the ids, coarse scores and full scores
+    of the SHORTLIST_SIZE candidate rows (None for all of them) with the highest coarse scores, in no particular order.
+    """
+    scan = coarse if rows is None else coarse[rows]
+    # One matrix product for the whole batch of queries
+    scan_scores = scan @ truncate(queries, coarse.shape[1]).T
+    results = []
+    for column, query in enumerate(queries):
+        best = rank(scan_scores[:, column], SHORTLIST_SIZE)
+        best_rows = best if rows is None else rows[best]
+        results.append((ids[best_rows], scan_scores[best, column], similarities(vectors[best_rows], query[np.newaxis])[:, 0]))
+    return results
+
+
+def rerank(shortlists: list[tuple[np.ndarray, np.ndarray, np.ndarray]], k: int, threshold: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The second stage of a two-stage search. Combine the shortlists for a query (one per shard, or just one), keep the
+    SHORTLIST_SIZE with the highest coarse scores overall, and return the ids and full scores of the top k of those.
+    Because the shortlist is picked from all of them, the result doesn't depend on how the rows were split up.
+    """
+    ids, coarse_scores, scores = (np.concatenate(arrays) for arrays in zip(*shortlists))
+    best = rank(coarse_scores, SHORTLIST_SIZE)
+    keep = rank(scores[best], k, threshold)
+    return ids[best][keep], scores[best][keep]
+
+
+def search_rows(ids: np.ndarray, vectors: np.ndarray, coarse: Optional[np.ndarray], rows: Optional[np.ndarray],
+                queries: np.ndarray, k: int, threshold: float) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    Score the candidate rows (None for all of them) against each of the normalized queries. If coarse has any
+    columns, scan the coarse vectors and re-rank a shortlist with the full vectors, otherwise scan the full vectors.
+    Returns the ids and similarities of the top k above threshold for each query, most similar first.
+    """
+    if coarse is not None and two_stage(coarse.shape[1], k):
+        return [rerank([candidates], k, threshold) for candidates in shortlist(ids, vectors, coarse, rows, queries)]
+
+    scan = vectors if rows is None else vectors[rows]
+    scan_ids = ids if rows is None else ids[rows]
+    scan_scores = similarities(scan, queries)
+    results = []
+    for column in range(len(queries)):
+        keep = rank(scan_scores[:, column], k, threshold)
+        results.append((scan_ids[keep], scan_scores[keep, column]))
+    return results
+
+
+class VectorIndex:
+    def __init__(self, ids: np.ndarray, vectors: np.ndarray, prices: np.ndarray, coarse_dimensions: int = 0):
+        """
+        coarse_dimensions turns on the two-stage search (see above), 0 to always scan the full vectors
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        # Products without an embedding have a zero vector, never let them match
+        valid = norms[:, 0] > 0
+        ids = np.asarray(ids, dtype=np.int64)[valid]
+        vectors = vectors[valid] / norms[valid]
+        self._requested_coarse_dimensions = coarse_dimensions
+        self.coarse_dimensions = coarse_dimensions if 0 < coarse_dimensions < vectors.shape[1] else 0
+        self._state = _Snapshot(
+            ids=ids,
+            vectors=vectors.astype(vector_dtype(self.coarse_dimensions)),
+            coarse=truncate(vectors, self.coarse_dimensions),
+            prices=np.asarray(prices, dtype=np.float64)[valid],
+            alive=np.ones(len(ids), dtype=bool),
+            count=len(ids),
+        )
+        self._rows: dict[int, int] = {product_id: row for row, product_id in enumerate(ids.tolist())}
+        self._tombstones = 0
+        self._write_lock = threading.Lock()
+        self._compacting = False
+        # Incremented on every change to the contents, so copies (see sharded_index.py) can tell they are out of date
+        self.version = 0
+
+    @classmethod
+    def from_rows(cls, rows: list[tuple[int, float, str]], coarse_dimensions: int = 0) -> "VectorIndex":
+        """
+        Build the index from (id, price, embedding) rows, where embedding is the CSV text stored in SQLite
+        """
+        parsed = [np.array(embedding.split(','), dtype=np.float32) if embedding else None for _, _, embedding in rows]
+        dimensions = max((len(vector) for vector in parsed if vector is not None), default=0)
+        vectors = np.zeros((len(rows), dimensions), dtype=np.float32)
+        for i, vector in enumerate(parsed):
+            if vector is not None and len(vector) == dimensions:
+                vectors[i] = vector
+        return cls([row[0] for row in rows], vectors, [row[1] for row in rows], coarse_dimensions)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @property
+    def dimensions(self) -> int:
+        return self._state.vectors.shape[1]
+
+    def live(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The ids, normalized vectors, coarse vectors and prices of the products in the index
+        """
+        state = self._state
+        keep = np.flatnonzero(state.alive[:state.count])
+        return state.ids[keep], state.vectors[keep], state.coarse[keep], state.prices[keep]
+
+    def export(self, allocate: Callable[[str, tuple, np.dtype], np.ndarray]) -> tuple[dict[str, np.ndarray], int]:
+        """
+        Copy the live rows straight into arrays from allocate(name, shape, dtype), e.g. shared memory, without
+        another copy in between. Returns the arrays (ids, vectors, coarse and prices) and the version they are from.
+        """
+        with self._write_lock:
+            # Rows before count are never changed in place, only marked dead, so they can be copied without the lock
+            state, version = self._state, self.version
+            keep = np.flatnonzero(state.alive[:state.count])
+        arrays = {}
+        for name in ("ids", "vectors", "coarse", "prices"):
+            source = getattr(state, name)
+            arrays[name] = allocate(name, (len(keep), *source.shape[1:]), source.dtype)
+            np.take(source, keep, axis=0, out=arrays[name])
+        return arrays, version
+
+    def adopt(self, arrays: dict[str, np.ndarray], version: int) -> bool:
+        """
+        Use arrays from export() as the index's own, and drop the current ones, so there is only one copy of the
+        catalog in memory. Does nothing (and returns False) if the index has changed since the export.
+        """
+        with self._write_lock:
+            if version != self.version:
+                return False
+            count = len(arrays["ids"])
+            self._state = _Snapshot(**arrays, alive=np.ones(count, dtype=bool), count=count)
+            self._rows = {product_id: row for row, product_id in enumerate(arrays["ids"].tolist())}
+            self._tombstones = 0
+            return True
+
+    def upsert(self, product_id: int, embedding: Optional[list[float]], price: float):
+        """
+        Add or replace a product. A product without an embedding is removed from the index.
+        """
+        vector = _normalize(embedding) if embedding else None
+        with self._write_lock:
+            self._delete(product_id)
+            if vector is None:
+                return
+            state = self._state
+            if state.count == 0 and len(vector) != self.dimensions:
+                # The first vector in an empty index decides the dimensions
+                state = self._resize(state, MIN_CAPACITY, len(vector))
+            if len(vector) != self.dimensions:
+                logging.warning(f"Not indexing product {product_id}, it has {len(vector)} dimensions instead of {self.dimensions}")
+                return
+            if state.count == len(state.ids):
+                # Grow by a quarter rather than doubling, for large catalogs the spare rows are a lot of memory
+                state = self._resize(state, state.count + max(MIN_CAPACITY, state.count // 4))
+
+            # Write the row past the end of the snapshot the readers can see, then publish it
+            row = state.count
+            state.ids[row] = product_id
+            state.vectors[row] = vector
+            state.coarse[row] = truncate(vector, self.coarse_dimensions)
+            state.prices[row] = price
+            state.alive[row] = True
+            self._state = state._replace(count=row + 1)
+            self._rows[product_id] = row
+            self.version += 1
+
+    def delete(self, product_id: int):
+        with self._write_lock:
+            self._delete(product_id)
+
+    def _delete(self, product_id: int):
+        row = self._rows.pop(product_id, None)
+        if row is None:
+            return
+        self._state.alive[row] = False
+        self._tombstones += 1
+        self.version += 1
+        if self._tombstones > COMPACT_RATIO * self._state.count and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self.compact, name="vector-index-compact", daemon=True).start()
+
+    def _resize(self, state: _Snapshot, capacity: int, dimensions: Optional[int] = None) -> _Snapshot:
+        """
+        Copy the live part of the arrays into new arrays with room for capacity rows (call with the write lock held)
+        """
+        dimensions = self.dimensions if dimensions is None else dimensions
+        # An empty index only finds out its dimensions from the first vector
+        requested = self._requested_coarse_dimensions
+        self.coarse_dimensions = requested if 0 < requested < dimensions else 0
+        count = state.count
+        resized = _Snapshot(
+            ids=np.zeros(capacity, dtype=np.int64),
+            vectors=np.zeros((capacity, dimensions), dtype=vector_dtype(self.coarse_dimensions)),
+            coarse=np.zeros((capacity, self.coarse_dimensions), dtype=np.float32),
+            prices=np.zeros(capacity, dtype=np.float64),
+            alive=np.zeros(capacity, dtype=bool),
+            count=count,
+        )
+        if count:
+            resized.ids[:count] = state.ids[:count]
+            resized.vectors[:count] = state.vectors[:count]
+            resized.coarse[:count] = state.coarse[:count]
+            resized.prices[:count] = state.prices[:count]
+            resized.alive[:count] = state.alive[:count]
+        self._state = resized
+        return resized
+
+    def compact(self):
+        """
+        Drop the tombstoned rows. Writes wait for this, but searches carry on with the old snapshot.
+        """
+        with self._write_lock:
+            state = self._state
+            keep = np.flatnonzero(state.alive[:state.count])
+            capacity = max(MIN_CAPACITY, len(keep) + len(keep) // 4)
+            compacted = _Snapshot(
+                ids=np.zeros(capacity, dtype=np.int64),
+                vectors=np.zeros((capacity, self.dimensions), dtype=state.vectors.dtype),
+                coarse=np.zeros((capacity, self.coarse_dimensions), dtype=np.float32),
+                prices=np.zeros(capacity, dtype=np.float64),
+                alive=np.zeros(capacity, dtype=bool),
+                count=len(keep),
+            )
+            compacted.ids[:len(keep)] = state.ids[keep]
+            compacted.vectors[:len(keep)] = state.vectors[keep]
+            compacted.coarse[:len(keep)] = state.coarse[keep]
+            compacted.prices[:len(keep)] = state.prices[keep]
+            compacted.alive[:len(keep)] = True
+            self._rows = {product_id: row for row, product_id in enumerate(compacted.ids[:len(keep)].tolist())}
+            self._state = compacted
+            logging.info(f"Compacted vector index, removed {state.count - len(keep)} rows")
+            self._tombstones = 0
+            self._compacting = False
+
+    def candidates(self, state: _Snapshot, filters: Optional[SearchFilters] = None) -> Optional[np.ndarray]:
+        """
+        Row numbers that are alive and pass the filters, or None if that is all of the rows
+        """
+        alive = state.alive[:state.count]
+        mask = price_mask(state.prices[:state.count], filters)
+        if mask is None:
+            if alive.all():
+                return None
+            mask = alive
+        else:
+            mask &= alive
+        return np.flatnonzero(mask)
+
+    def search(self, embedding: list[float], k: int, filters: Optional[SearchFilters] = None, threshold: float = -1.0,
+               exact: bool = False) -> list[tuple[int, float]]:
+        """
+        Return the (id, similarity) of the k most similar products with a similarity above threshold, most similar first.
+        exact=True scans the full vectors even if the index has coarse dimensions.
+        """
+        state = self._state
+        if k <= 0 or not state.count:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        if query.shape[0] != state.vectors.shape[1]:
+            raise ValueError(f"The query embedding has {query.shape[0]} dimensions, but the index has {state.vectors.shape[1]}")
+        norm = np.linalg.norm(query)
+        if not norm:
+            return []
+
+        count = state.count
+        [(ids, scores)] = search_rows(state.ids[:count], state.vectors[:count], None if exact else state.coarse[:count],
+                                      self.candidates(state, filters), (query / norm)[np.newaxis], k, threshold)
+        return list(zip(ids.tolist(), scores.tolist()))
+
+    def recall(self, queries: Optional[list[list[float]]] = None, k: int = 10, sample: int = 100) -> float:
+        """
+        The fraction of the exact top k results that the two-stage search also returns, averaged over the queries.
+        Without queries, a random sample of the indexed vectors is used as the queries. Each of those is its own
+        best match in both searches, which would inflate the recall, so its own product is left out of the results.
+        """
+        own_ids: list[Optional[int]] = []
+        if queries is None:
+            ids, vectors, _, _ = self.live()
+            sampled = np.random.default_rng(0).permutation(len(vectors))[:sample]
+            queries = vectors[sampled]
+            own_ids = ids[sampled].tolist()
+        found = 0
+        total = 0
+        for i, query in enumerate(queries):
+            own_id = own_ids[i] if own_ids else None
+            exact = [product_id for product_id, _ in self.search(query, k + 1, exact=True) if product_id != own_id][:k]
+            approximate = [product_id for product_id, _ in self.search(query, k + 1) if product_id != own_id][:k]
+            found += len(set(exact) & set(approximate))
+            total += len(exact)
+        return found / total if total else 1.0
@@ -8,12 +8,23 @@ import json
 import logging
 import pathlib
 import httpx
-from openai import AzureOpenAI
 import azure.functions as func
 from embeddings import fetch_embedding, fetch_computer_vision_image_embedding
 
 
-def add_dev_functions(app, client: AzureOpenAI, completions_deployment, embeddings_deployment, vision_api_key, vision_endpoint, token_provider, USE_COMPUTER_VISION=False):
+def add_dev_functions(app, get_client, completions_deployment, embeddings_deployment, vision_api_key, vision_endpoint, get_token_provider, USE_COMPUTER_VISION=False, USE_COSMOSDB=False):
+    """
+    get_client and get_token_provider are called when a function runs, so the OpenAI client isn't created at import time.
+    """
+
+    def update_local_backend(products: list[dict]):
+        # The local backend only reloads data/test.json when it starts, so send the changes to the running one too
+        if USE_COSMOSDB:
+            return
+        from backends.local import upsert_product
+
+        for product in products:
+            upsert_product(product)
 
     @app.route(methods=["get"], auth_level="anonymous",
             route="seed_embeddings")
@@ -32,13 +43,13 @@ def add_dev_functions(app, client: AzureOpenAI, completions_deployment, embeddin
                 if not diff:
                     update = True
                 if update:
-                    product['embedding'] = fetch_embedding(client, embeddings_deployment, product['name'] + ' ' + product['description'])
+                    product['embedding'] = fetch_embedding(get_client(), embeddings_deployment, product['name'] + ' ' + product['description'])
                     if USE_COMPUTER_VISION:
                         image = pathlib.Path("../html/images/products/") / product['image']
                         if image.exists():
                             product['image_embedding'] = fetch_computer_vision_image_embedding(vision_api_key=vision_api_key,
                                                                                             vision_endpoint=vision_endpoint,
-                                                                                            token_provider=token_provider,
+                                                                                            token_provider=get_token_provider(),
                                                                                             data=image, 
                                                                                             mimetype="image/jpeg")
                         else:
@@ -47,10 +58,29 @@ def add_dev_functions(app, client: AzureOpenAI, completions_deployment, embeddin
             # Write the embeddings back to the test data
             with open('data/test.json', 'w') as f:
                 json.dump(data, f)
+            update_local_backend(data)
                     
             return func.HttpResponse("Successfully seeded embeddings")
 
 
+    if not USE_COSMOSDB:
+        @app.route(methods=["get"], auth_level="anonymous",
+                    route="recall_report")
+        def recall_report(req: func.HttpRequest) -> func.HttpResponse:
+            """
+            Report the recall of the two-stage (coarse then full dimension) vector search in the local backend
+            """
+            from backends.local import recall_report
+
+            try:
+                k = int(req.params.get('k', 10))
+                if k <= 0:
+                    raise ValueError
+            except ValueError:
+                return func.HttpResponse(json.dumps({"error": "k must be a positive integer"}), status_code=400)
+            return func.HttpResponse(json.dumps(recall_report(k=k)), mimetype="application/json")
+
+
     @app.route(methods=["get"], auth_level="anonymous",
                 route="seed_test_data")
     def seed_test_data(req: func.HttpRequest) -> func.HttpResponse:
@@ -79,7 +109,7 @@ def add_dev_functions(app, client: AzureOpenAI, completions_deployment, embeddin
 
         for _ in range(25):
 
-            completion = client.chat.completions.create(
+            completion = get_client().chat.completions.create(
                 model="gpt-4o", # use the GPT-4o model for generating test data because it has more parameters
                 messages= [
                 {
@@ -197,6 +227,7 @@ def add_dev_functions(app, client: AzureOpenAI, completions_deployment, embeddin
         # Write the data to the test.json file
         with open('data/test.json', 'w') as f:
             json.dump(existing_data + new_data, f, indent=4)
+        update_local_backend(new_data)
         return func.HttpResponse(body=json.dumps(data))
     
     @app.route(methods=["get"], auth_level="anonymous",
@@ -221,7 +252,7 @@ def add_dev_functions(app, client: AzureOpenAI, completions_deployment, embeddin
         # Use dall-e 3 to generate an image
         try:
             prompt = f"A photorealistic product image with a plain for a item with this description '{next_product['description']}'. Do not include the person with the product."
-            response = client.images.generate(
+            response = get_client().images.generate(
                 model="dall-e-3",
                 prompt=prompt,
                 size="1024x1024",
@@ -1,19 +1,27 @@
+import os
 import pathlib
-import httpx
 from urllib.parse import urljoin
 import logging
 
+# Shortened embeddings are only supported in the text-embedding-3 models. The stored embeddings and the
+# vector indexes (the Cosmos vector_embedding_policy) are checked against this, they need the same number of dimensions.
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", 1024))
+# The Computer Vision image embeddings are always 1024 dimensions
+IMAGE_EMBEDDING_DIMENSIONS = 1024
+
 
 def fetch_embedding(client, embeddings_deployment: str, input: str) -> list[float]:
     embedding = client.embeddings.create(
         input=input,
         model=embeddings_deployment,
-        dimensions=1024,  # this is only supported in the text-embedding-3 models
+        dimensions=EMBEDDING_DIMENSIONS,
     )
     return embedding.data[0].embedding
 
 
 def fetch_computer_vision_image_embedding(vision_endpoint: str, vision_api_key: str, token_provider, data: bytes | pathlib.Path, mimetype: str) -> list[float]:
+    import httpx
+
     if isinstance(data, pathlib.Path):
         with open(data, "rb") as f:
             data = f.read()
@@ -1,56 +1,181 @@
 import azure.functions as func
 import logging
 import json
+import math
 
-from azure.identity import AzureCliCredential, get_bearer_token_provider
-from openai import AzureOpenAI
+import functools
+import importlib
 import os
 import pathlib
+import threading
+import time
 from base64 import b64encode
+from typing import TYPE_CHECKING, Optional
 from embeddings import fetch_embedding, fetch_computer_vision_image_embedding
+from timing import RequestTimer, configure_telemetry, span
+
+if TYPE_CHECKING:
+    from openai import AzureOpenAI
+    from backends.models import SearchFilters
 
-client: AzureOpenAI
 DEVELOPMENT = bool(int(os.getenv("DEVELOPMENT", 0)))
 
 # Set to False if you don't have access to the Azure Computer Vision API
 USE_COMPUTER_VISION = True
 
-if os.getenv("AZURE_OPENAI_ENDPOINT") and os.getenv("AZURE_OPENAI_KEY"):
-    client = AzureOpenAI(
-        api_version="2024-02-15-preview",
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_KEY")
-    )
-    token_provider = None
-else:
+# Load the backend and the OpenAI client in a background thread when the first function runs,
+# so concurrent and later requests don't have to
+WARM_UP = bool(int(os.getenv("WARM_UP", 1)))
+
+
+# The OpenAI and Azure Identity SDKs take a long time to import, so they are only imported
+# (and the clients created) the first time they are needed, not when the function app is loaded.
+@functools.cache
+def get_token_provider():
+    if os.getenv("AZURE_OPENAI_ENDPOINT") and os.getenv("AZURE_OPENAI_KEY"):
+        return None
+    from azure.identity import AzureCliCredential, get_bearer_token_provider
+
     azure_credential = AzureCliCredential(tenant_id=os.getenv("AZURE_TENANT_ID"))
-    token_provider = get_bearer_token_provider(azure_credential,
+    return get_bearer_token_provider(azure_credential,
         "https://cognitiveservices.azure.com/.default")
-    client = AzureOpenAI(
+
+
+@functools.cache
+def get_client() -> "AzureOpenAI":
+    from openai import AzureOpenAI
+
+    token_provider = get_token_provider()
+    if not token_provider:
+        return AzureOpenAI(
+            api_version="2024-02-15-preview",
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_KEY")
+        )
+    return AzureOpenAI(
         api_version="2024-02-15-preview",
         azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
         azure_ad_token_provider=token_provider
     )
 
+
 completions_deployment = os.getenv("CHAT_DEPLOYMENT_NAME", "gpt-4o")
 embeddings_deployment = os.getenv("EMBEDDINGS_DEPLOYMENT_NAME", "text-embedding-3-small")
 vision_endpoint = os.getenv("VISION_ENDPOINT")
 vision_api_key = os.getenv("VISION_API_KEY")
 
 if not os.getenv("AZURE_COSMOS_CONNECTION_STRING"):
-    from backends.local import search_products, search_images
+    BACKEND_MODULE = "backends.local"
 
     USE_COSMOSDB = False
 else:
-    from backends.azure_cosmos import search_products, search_images, \
-                                      DEFAULT_DATABASE_NAME, DEFAULT_CONTAINER_NAME, \
-                                      update_product, \
-                                      DESCRIPTION_EMBEDDING_FIELD, IMAGE_EMBEDDING_FIELD
+    # Only the names for the trigger, the backend itself is imported on first use (see get_backend)
+    from backends.cosmos_settings import DEFAULT_DATABASE_NAME, DEFAULT_CONTAINER_NAME, \
+                                         DESCRIPTION_EMBEDDING_FIELD, IMAGE_EMBEDDING_FIELD
+    BACKEND_MODULE = "backends.azure_cosmos"
 
     USE_COSMOSDB = True
 
+
+@functools.cache
+def get_backend():
+    """
+    The backend module (backends.local or backends.azure_cosmos), imported on first use
+    """
+    return importlib.import_module(BACKEND_MODULE)
+
+
+def warm_up():
+    try:
+        configure_telemetry()
+    except Exception:
+        logging.exception("Failed to configure telemetry")
+    if not WARM_UP:
+        return
+
+    start = time.perf_counter()
+    try:
+        backend = get_backend()
+        if hasattr(backend, "warm_up"):
+            backend.warm_up()
+        get_client()
+    except Exception:
+        # Not fatal, the same error will be raised (and reported) by the first request
+        logging.exception("Failed to warm up")
+        return
+    logging.info(f"Warmed up the backend and OpenAI client in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+
+_warm_up_lock = threading.Lock()
+_warm_up_started = False
+
+
+def start_warm_up():
+    """
+    Start the warm-up thread, once. This is called by the functions rather than when function_app is
+    imported, so it doesn't compete for the GIL with the host loading and indexing the functions.
+    """
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
 app = func.FunctionApp()
 
+MAX_SEARCH_LIMIT = 50
+# Deep pages rank every result before them, so they are limited too
+MAX_SEARCH_OFFSET = 1000
+
+
+def parse_search_params(req: func.HttpRequest, default_limit: int = 10,
+                        legacy_limit_field: Optional[str] = None) -> tuple[int, int, "SearchFilters"]:
+    """
+    Read the paging (limit, offset) and filter (min_price, max_price) fields from the form.
+    legacy_limit_field is an older name for limit, which had no maximum, so it is clamped to MAX_SEARCH_LIMIT.
+    Raises ValueError if any of them are invalid.
+    """
+    from backends.models import SearchFilters
+
+    if req.form.get('limit'):
+        limit = parse_int(req.form['limit'], 'limit')
+    elif legacy_limit_field and req.form.get(legacy_limit_field):
+        limit = min(parse_int(req.form[legacy_limit_field], legacy_limit_field), MAX_SEARCH_LIMIT)
+    else:
+        limit = default_limit
+    offset = parse_int(req.form.get('offset') or '0', 'offset')
+    if not 0 < limit <= MAX_SEARCH_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_SEARCH_LIMIT}")
+    if not 0 <= offset <= MAX_SEARCH_OFFSET:
+        raise ValueError(f"offset must be between 0 and {MAX_SEARCH_OFFSET}")
+
+    return limit, offset, SearchFilters(
+        min_price=parse_price(req.form.get('min_price'), 'min_price'),
+        max_price=parse_price(req.form.get('max_price'), 'max_price'),
+    )
+
+
+def parse_int(value: str, name: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a whole number") from None
+
+
+def parse_price(value: Optional[str], name: str) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        price = float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number") from None
+    # float() accepts "nan" and "inf", which would match nothing (or everything)
+    if not math.isfinite(price):
+        raise ValueError(f"{name} must be a number")
+    return price
+
 
 def prep_search(query: str) -> str:
     """
@@ -61,7 +186,7 @@ def prep_search(query: str) -> str:
     """
 
     ### Start of implementation
-    completion = client.chat.completions.create(
+    completion = get_client().chat.completions.create(
         model=completions_deployment,
         messages= [
         {
@@ -106,6 +231,9 @@ def prep_search(query: str) -> str:
 @app.route(methods=["post"], auth_level="anonymous",
                     route="search")
 def search(req: func.HttpRequest) -> func.HttpResponse:
+    from backends.models import dump_search_response
+
+    start_warm_up()
     logging.info("Python HTTP trigger function processed a request.")
     query = req.form.get('query')
     if not query:
@@ -113,16 +241,22 @@ def search(req: func.HttpRequest) -> func.HttpResponse:
             "{'error': 'Please pass a query on the query string or in the request body'}",
             status_code=400
         )
+    try:
+        limit, offset, filters = parse_search_params(req)
+    except ValueError as e:
+        return func.HttpResponse(json.dumps({"error": str(e)}), status_code=400)
+
+    with RequestTimer("search") as timer:
+        with span("prep_search"):
+            fts_query = prep_search(query)
+        with span("embedding"):
+            embedding = fetch_embedding(get_client(), embeddings_deployment, query)
+        sql_results = get_backend().search_products(query, fts_query, embedding, limit, offset, filters)
 
-    fts_query = prep_search(query)
-    embedding = fetch_embedding(client, embeddings_deployment, query)
-    sql_results = search_products(query, fts_query, embedding)
+        with span("serialize"):
+            body = dump_search_response(fts_query, sql_results)
 
-    return func.HttpResponse(json.dumps({
-        "keywords": fts_query,
-        "results": [product.model_dump() for product in sql_results]
-        }
-    ))
+    return func.HttpResponse(body, headers=timer.headers())
 
 
 @app.route(methods=['post'], auth_level="anonymous",
@@ -131,60 +265,71 @@ def match(req: func.HttpRequest) -> func.HttpResponse:
     """
     Matches the image upload with the product in the database with the closest embedding.
     """
+    from backends.models import dump_search_response
+
+    start_warm_up()
     image = req.files.get('image_upload')
-    max_items = req.form.get('max_items', 2)
     if not image:
         return func.HttpResponse(
             "{'error': 'Please pass an image in the request body'}",
             status_code=400
         )
-    image_contents = image.stream.read()
-    image_type = image.mimetype
+    try:
+        # max_items is the original name for the page size
+        limit, offset, filters = parse_search_params(req, default_limit=2, legacy_limit_field='max_items')
+    except ValueError as e:
+        return func.HttpResponse(json.dumps({"error": str(e)}), status_code=400)
+    with RequestTimer("match") as timer:
+        image_contents = image.stream.read()
+        image_type = image.mimetype
 
-    base64_image = b64encode(image_contents).decode('utf-8')
+        base64_image = b64encode(image_contents).decode('utf-8')
 
-    # 1. Ask the model to describe the image
-    description = client.chat.completions.create(
-        model=completions_deployment,
-        messages= [
-        {
-            "role": "system",
-            "content": 
-            """  
-                Generate a text description the clothes worn by the person in the image.
-            """
-        },
-        {   
-            "role": "user",
-            "content": [
-                { "type": "text", "content": "Describe the clothes in this image" },
-                { "type": "image_url", "image_url": { "url": f"data:{image_type};base64,{base64_image}" } }
-            ]
-        }
-        ],
-        max_tokens=500, # maximum number of tokens to generate
-        n=1, # return only one completion
-        stop=None, # stop at the end of the completion
-        temperature=0.3, # more predictable
-        stream=False, # return the completion as a single string
-        seed=1, # seed for reproducibility
-    )
-    image_description = description.choices[0].message.content
+        # 1. Ask the model to describe the image
+        with span("describe_image"):
+            description = get_client().chat.completions.create(
+                model=completions_deployment,
+                messages= [
+                {
+                    "role": "system",
+                    "content": 
+                    """  
+                        Generate a text description the clothes worn by the person in the image.
+                    """
+                },
+                {   
+                    "role": "user",
+                    "content": [
+                        { "type": "text", "content": "Describe the clothes in this image" },
+                        { "type": "image_url", "image_url": { "url": f"data:{image_type};base64,{base64_image}" } }
+                    ]
+                }
+                ],
+                max_tokens=500, # maximum number of tokens to generate
+                n=1, # return only one completion
+                stop=None, # stop at the end of the completion
+                temperature=0.3, # more predictable
+                stream=False, # return the completion as a single string
+                seed=1, # seed for reproducibility
+            )
+        image_description = description.choices[0].message.content
 
-    embedding_source = req.form.get('embedding_source', 'text')
+        embedding_source = req.form.get('embedding_source', 'text')
 
-    if USE_COMPUTER_VISION and embedding_source == 'image':
-        image_embedding = fetch_computer_vision_image_embedding(vision_endpoint, vision_api_key, token_provider, image_contents, image_type)
-        sql_results = search_images(image_embedding)[:max_items]
-    else:
-        # Do a product search with the text embedding
-        text_embedding = fetch_embedding(client, embeddings_deployment, image_description)
-        sql_results = search_products(image_description, image_description, text_embedding)[:max_items]
+        if USE_COMPUTER_VISION and embedding_source == 'image':
+            with span("image_embedding"):
+                image_embedding = fetch_computer_vision_image_embedding(vision_endpoint, vision_api_key, get_token_provider(), image_contents, image_type)
+            sql_results = get_backend().search_images(image_embedding, limit, offset, filters)
+        else:
+            # Do a product search with the text embedding
+            with span("embedding"):
+                text_embedding = fetch_embedding(get_client(), embeddings_deployment, image_description)
+            sql_results = get_backend().search_products(image_description, image_description, text_embedding, limit, offset, filters)
+
+        with span("serialize"):
+            body = dump_search_response(image_description, sql_results)
 
-    return func.HttpResponse(json.dumps({
-        "keywords": image_description,
-        "results": [product.model_dump() for product in sql_results],
-        }))
+    return func.HttpResponse(body, headers=timer.headers())
 
 if USE_COSMOSDB:
     @app.function_name(name="CosmosDBTrigger")
@@ -195,13 +340,14 @@ if USE_COSMOSDB:
                         lease_container_name="leases",
                         create_lease_container_if_not_exists="true")
     def update_embedding_for_document(documents: func.DocumentList) -> str:
+        start_warm_up()
         if documents:
             logging.info('Document id: %s', documents[0]['id'])
         
         for doc in documents:
             has_changes = False
             # Determine if the name or description has changed
-            embedding = fetch_embedding(client, embeddings_deployment, doc['name'] + " " + doc['description'])
+            embedding = fetch_embedding(get_client(), embeddings_deployment, doc['name'] + " " + doc['description'])
             if doc.get(DESCRIPTION_EMBEDDING_FIELD) != embedding:
                 has_changes = True
                 doc[DESCRIPTION_EMBEDDING_FIELD] = embedding
@@ -210,7 +356,7 @@ if USE_COSMOSDB:
             if USE_COMPUTER_VISION:
                 image_embedding = fetch_computer_vision_image_embedding(vision_api_key=vision_api_key,
                                                                         vision_endpoint=vision_endpoint,
-                                                                        token_provider=token_provider,
+                                                                        token_provider=get_token_provider(),
                                                                         data=pathlib.Path("../html/images/products/") / doc['image'], 
                                                                         mimetype="image/jpeg")
                 if doc.get(IMAGE_EMBEDDING_FIELD) != image_embedding:
@@ -219,9 +365,9 @@ if USE_COSMOSDB:
                     logging.info(f"Updated image embedding for {doc['name']}")
 
             if has_changes:
-                update_product(doc)
+                get_backend().update_product(doc)
 
 if DEVELOPMENT:
     from dev_functions import add_dev_functions
 
-    add_dev_functions(app, client, completions_deployment, embeddings_deployment, vision_api_key, vision_endpoint, token_provider, USE_COMPUTER_VISION)
+    add_dev_functions(app, get_client, completions_deployment, embeddings_deployment, vision_api_key, vision_endpoint, get_token_provider, USE_COMPUTER_VISION, USE_COSMOSDB)
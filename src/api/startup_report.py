@@ -0,0 +1,69 @@
+"""
+Report how long it takes to import the function app, using python -X importtime.
+
+The Functions host imports function_app.py on every cold start, so anything slow in here adds
+to the first request after a scale-out. Run this after changing imports to catch regressions:
+
+    python startup_report.py --top 15 --budget-ms 500
+
+Exits with status 1 if the import takes longer than the budget.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+def measure(module: str) -> list[tuple[int, int, int, str]]:
+    """
+    Import the module in a fresh interpreter and return (self_us, cumulative_us, depth, name) for every import
+    """
+    env = dict(os.environ, WARM_UP="0")
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if process.returncode != 0:
+        sys.stderr.write(process.stderr)
+        raise SystemExit(f"Failed to import {module}")
+
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # the header line
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="function_app")
+    parser.add_argument("--top", type=int, default=10, help="Show the slowest N top-level imports")
+    parser.add_argument("--budget-ms", type=float, default=None, help="Fail if the import takes longer than this")
+    args = parser.parse_args()
+
+    imports = measure(args.module)
+    # importtime lists the children before their parent, so the module's own imports are the
+    # depth 1 entries between the module and the previous top-level import
+    end = max(i for i, (_, _, depth, name) in enumerate(imports) if depth == 0 and name == args.module)
+    start = end
+    while start > 0 and imports[start - 1][2] > 0:
+        start -= 1
+    total_ms = imports[end][1] / 1000
+
+    # The imports made directly by the module are the ones we can do something about
+    direct = sorted((i for i in imports[start:end] if i[2] == 1), key=lambda i: i[1], reverse=True)
+    print(f"import {args.module}: {total_ms:.1f}ms")
+    for _, cumulative, _, name in direct[:args.top]:
+        print(f"  {cumulative / 1000:8.1f}ms  {name}")
+
+    if args.budget_ms is not None and total_ms > args.budget_ms:
+        print(f"Import time {total_ms:.1f}ms is over the budget of {args.budget_ms:.0f}ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import json
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+
+# The function app imports its modules relative to src/api, like the Functions host does
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+
+def random_vectors(count: int, dimensions: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).normal(size=(count, dimensions)).astype(np.float32)
+
+
+@pytest.fixture
+def local_backend(tmp_path, monkeypatch):
+    """
+    The local backend with a fresh database, loaded from a small generated data/test.json
+    """
+    from backends import local
+
+    vectors = random_vectors(40, 16)
+    products = [{
+        "id": i + 1,
+        "name": f"{['red', 'blue'][i % 2]} {['jacket', 'dress', 'boots', 'hat'][i % 4]}",
+        "description": f"Product number {i + 1}",
+        "image": f"{i + 1}.jpeg",
+        "price": 10.0 + i,
+        "embedding": vectors[i].tolist(),
+        "image_embedding": None,
+    } for i in range(len(vectors))]
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "test.json").write_text(json.dumps(products))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(local, "DATABASE", str(tmp_path / "test.db"))
+    monkeypatch.setattr(local, "_pool", None)
+    monkeypatch.setattr(local, "_indexes", {})
+    monkeypatch.setattr(local, "_index_versions", {})
+    yield local
+    if local._pool is not None:
+        local._pool.close()
@@ -0,0 +1,114 @@
+import json
+import os
+import sqlite3
+import time
+
+import pytest
+
+
+def keyword_ids(local, query: str) -> list[int]:
+    with local.get_pool().reader() as conn:
+        return [product[0] for product in local.keyword_search_products(conn.cursor(), query, query, 100)]
+
+
+def test_fts_index_follows_upsert_and_delete(local_backend):
+    local = local_backend
+    if not local.has_fts5():
+        pytest.skip("SQLite was built without FTS5")
+    assert keyword_ids(local, "parka") == []
+
+    product_id = local.upsert_product({"name": "Yellow parka", "description": "A warm coat", "image": "new.jpeg", "price": 99.0})
+    assert keyword_ids(local, "parka") == [product_id]
+
+    local.upsert_product({"id": product_id, "name": "Yellow raincoat", "description": "A dry coat", "image": "new.jpeg", "price": 99.0})
+    assert keyword_ids(local, "parka") == []
+    assert keyword_ids(local, "raincoat") == [product_id]
+
+    local.delete_product(product_id)
+    assert keyword_ids(local, "raincoat") == []
+
+
+def test_upsert_and_delete_update_the_vector_index(local_backend):
+    local = local_backend
+    embedding = [1.0] + [0.0] * 15
+    # Build the index first, so the upsert has to update it in place
+    local.search_products("nothing", "nothing", embedding, 5)
+
+    product_id = local.upsert_product({"name": "Yellow parka", "description": "A warm coat", "image": "new.jpeg",
+                                       "price": 99.0, "embedding": embedding})
+    assert local.search_products("nothing", "nothing", embedding, 1)[0].id == product_id
+    local.upsert_product({"id": product_id, "name": "Yellow parka", "description": "A warm coat", "image": "new.jpeg",
+                          "price": 99.0, "embedding": embedding})
+    assert [result.id for result in local.search_products("nothing", "nothing", embedding, 50)].count(product_id) == 1
+
+    local.delete_product(product_id)
+    assert product_id not in [result.id for result in local.search_products("nothing", "nothing", embedding, 50)]
+
+
+@pytest.mark.parametrize("coarse_dimensions", [0, 4])
+def test_paging_matches_one_large_page(local_backend, monkeypatch, coarse_dimensions):
+    local = local_backend
+    monkeypatch.setitem(local.COARSE_DIMENSIONS, "embedding", coarse_dimensions)
+    embedding = [0.5] * 16
+    everything = [result.id for result in local.search_products("jacket", "jacket", embedding, 30)]
+    pages = [result.id for offset in range(0, 30, 7) for result in local.search_products("jacket", "jacket", embedding, 7, offset)]
+    assert pages[:30] == everything
+
+
+def test_test_data_is_reloaded_when_it_changes(local_backend, monkeypatch):
+    local = local_backend
+    assert keyword_ids(local, "parka") == []
+    local._pool.close()
+
+    data = json.loads(open(local.TEST_DATA).read())
+    data.append({"id": 500, "name": "Yellow parka", "description": "A warm coat", "image": "500.jpeg", "price": 99.0})
+    with open(local.TEST_DATA, "w") as f:
+        json.dump(data, f)
+    os.utime(local.TEST_DATA, ns=(time.time_ns() + 10**9, time.time_ns() + 10**9))
+    monkeypatch.setattr(local, "_pool", None)
+
+    assert keyword_ids(local, "parka") == [500]
+    with local.get_pool().reader() as conn:
+        assert conn.execute("SELECT count(*) FROM products").fetchone()[0] == len(data)
+
+
+def write_from_another_process(local, sql: str, params: tuple = ()):
+    # A separate connection, like another worker process using the same database
+    conn = sqlite3.connect(local.DATABASE, isolation_level=None)
+    conn.execute(sql, params)
+    conn.close()
+
+
+def test_vector_index_follows_changes_from_other_processes(local_backend):
+    local = local_backend
+    embedding = [1.0] + [0.0] * 15
+    before = [result.id for result in local.search_products("nothing", "nothing", embedding, 40)]
+    index = local._indexes["embedding"]
+
+    write_from_another_process(local, "INSERT INTO products (id, name, description, image, price, embedding) VALUES (?, ?, ?, ?, ?, ?)",
+                               (600, "Yellow parka", "A warm coat", "600.jpeg", 99.0, local.to_csv(embedding)))
+    write_from_another_process(local, "DELETE FROM products WHERE id = ?", (before[1],))
+
+    after = [result.id for result in local.search_products("nothing", "nothing", embedding, 40)]
+    assert after[0] == 600
+    assert before[1] not in after
+    # Applied in place, not rebuilt
+    assert local._indexes["embedding"] is index
+    assert len(index) == 40
+
+
+def test_vector_index_is_rebuilt_when_too_far_behind(local_backend, monkeypatch):
+    local = local_backend
+    embedding = [1.0] + [0.0] * 15
+    local.search_products("nothing", "nothing", embedding, 5)
+    index = local._indexes["embedding"]
+
+    monkeypatch.setattr(local, "CHANGE_LOG_SIZE", 1)
+    for product_id in (700, 701):
+        local.upsert_product({"id": product_id, "name": "Yellow parka", "description": "A warm coat", "image": "new.jpeg", "price": 99.0})
+    write_from_another_process(local, "UPDATE products SET price = 1 WHERE id = 700")
+    write_from_another_process(local, "UPDATE products SET price = 2 WHERE id = 701")
+    write_from_another_process(local, "DELETE FROM productChanges WHERE version < (SELECT max(version) FROM productChanges)")
+
+    local.search_products("nothing", "nothing", embedding, 5)
+    assert local._indexes["embedding"] is not index
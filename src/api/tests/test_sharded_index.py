@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+import pytest
+
+from backends.models import SearchFilters
+from backends.sharded_index import ShardedVectorIndex
+from backends.vector_index import VectorIndex
+from conftest import random_vectors
+
+
+@pytest.fixture(scope="module", params=[0, 16], ids=["full", "coarse"])
+def indexes(request):
+    count = 2000
+    index = VectorIndex(np.arange(1, count + 1), random_vectors(count, 64), np.arange(count, dtype=float) % 100, request.param)
+    # Tombstones and appended rows, so the shared copy has to be built from the live rows
+    for product_id in range(1, count, 7):
+        index.delete(product_id)
+    for i, vector in enumerate(random_vectors(50, 64, seed=1)):
+        index.upsert(5000 + i, vector.tolist(), float(i))
+    sharded = ShardedVectorIndex(index, 3)
+    yield index, sharded
+    sharded.close()
+
+
+def ids_and_scores(results: list[tuple[int, float]]) -> tuple[list[int], np.ndarray]:
+    return [product_id for product_id, _ in results], np.array([similarity for _, similarity in results])
+
+
+@pytest.mark.parametrize("filters", [None, SearchFilters(min_price=20, max_price=40), SearchFilters(max_price=5)])
+def test_sharded_results_equal_in_process_results(indexes, filters):
+    index, sharded = indexes
+    queries = random_vectors(8, 64, seed=2)
+    batch = sharded.search_batch(queries.tolist(), 15, filters, 0.0)
+    for query, results in zip(queries, batch):
+        ids, scores = ids_and_scores(results)
+        expected_ids, expected_scores = ids_and_scores(index.search(query, 15, filters, 0.0))
+        assert ids == expected_ids
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+
+        single_ids, single_scores = ids_and_scores(sharded.search(query, 15, filters, 0.0))
+        assert single_ids == ids
+        np.testing.assert_allclose(single_scores, scores, rtol=1e-5)
+
+
+def test_sharded_query_with_the_wrong_dimensions_is_an_error(indexes):
+    _, sharded = indexes
+    with pytest.raises(ValueError):
+        sharded.search_batch(random_vectors(2, 32).tolist(), 10)
+
+
+def test_sharded_index_knows_when_it_is_out_of_date(indexes):
+    index, sharded = indexes
+    assert sharded.is_current(index)
+    index.upsert(9999, random_vectors(1, 64, seed=3)[0].tolist(), 1.0)
+    assert not sharded.is_current(index)
+    index.delete(9999)
+
+
+def test_index_uses_the_shared_copy():
+    index = VectorIndex(np.arange(1, 501), random_vectors(500, 32), np.zeros(500), 8)
+    for product_id in range(1, 500, 5):
+        index.delete(product_id)
+    query = random_vectors(1, 32, seed=4)[0]
+    expected = index.search(query, 10)
+
+    sharded = ShardedVectorIndex(index, 2)
+    paths = [path for path, _, _ in sharded._files.values()]
+    # The index dropped its own arrays (and the tombstones) for the shared ones
+    assert index._state.count == len(index) == 400
+    assert not index._state.vectors.flags.owndata
+    assert index.search(query, 10) == expected
+    assert sharded.is_current(index)
+
+    sharded.close()
+    assert not any(os.path.exists(path) for path in paths)
+    # The index's mappings outlive the files
+    assert index.search(query, 10) == expected
+    index.upsert(1000, query.tolist(), 1.0)
+    assert index.search(query, 1)[0][0] == 1000
+
+
+def test_changes_during_the_build_are_not_lost():
+    index = VectorIndex(np.arange(1, 101), random_vectors(100, 32), np.zeros(100))
+    arrays, version = index.export(lambda name, shape, dtype: np.empty(shape, dtype))
+    index.delete(1)
+    assert not index.adopt(arrays, version)
+    assert 1 not in index.live()[0]
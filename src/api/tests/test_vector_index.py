@@ -0,0 +1,149 @@
+import time
+
+import numpy as np
+import pytest
+
+from backends.models import SearchFilters
+from backends import vector_index
+from backends.vector_index import SHORTLIST_SIZE, VectorIndex
+from conftest import random_vectors
+
+
+def make_index(count: int = 200, dimensions: int = 32, coarse_dimensions: int = 0) -> VectorIndex:
+    vectors = random_vectors(count, dimensions)
+    return VectorIndex(np.arange(1, count + 1), vectors, np.arange(count, dtype=float), coarse_dimensions)
+
+
+def live_ids(index: VectorIndex) -> list[int]:
+    ids, _, _, _ = index.live()
+    return sorted(ids.tolist())
+
+
+def test_search_returns_the_exact_match_first():
+    index = make_index()
+    _, vectors, _, _ = index.live()
+    assert index.search(vectors[41], 1)[0][0] == 42
+
+
+def test_filters_are_applied_before_ranking():
+    index = make_index()
+    results = index.search(random_vectors(1, 32, seed=1)[0], 10, SearchFilters(min_price=50, max_price=59))
+    assert len(results) == 10
+    assert sorted(product_id for product_id, _ in results) == list(range(51, 61))
+
+
+def test_upsert_of_an_existing_id_replaces_it():
+    index = make_index()
+    replacement = random_vectors(1, 32, seed=2)[0]
+    index.upsert(7, replacement.tolist(), 1.0)
+    index.upsert(7, replacement.tolist(), 2.0)
+
+    assert len(index) == 200
+    assert live_ids(index) == list(range(1, 201))
+    results = index.search(replacement, 200)
+    assert [product_id for product_id, _ in results].count(7) == 1
+    assert results[0][0] == 7
+
+
+def test_upsert_without_an_embedding_removes_the_product():
+    index = make_index()
+    index.upsert(7, None, 1.0)
+    assert 7 not in live_ids(index)
+
+
+def test_upsert_past_the_capacity():
+    index = make_index(count=10)
+    new = random_vectors(500, 32, seed=3)
+    for i, vector in enumerate(new):
+        index.upsert(1000 + i, vector.tolist(), 1.0)
+    assert len(index) == 510
+    assert index.search(new[321], 1)[0][0] == 1321
+
+
+def test_delete():
+    index = make_index()
+    _, vectors, _, _ = index.live()
+    index.delete(42)
+    index.delete(42)
+    assert 42 not in live_ids(index)
+    assert 42 not in [product_id for product_id, _ in index.search(vectors[41], 200)]
+
+
+def test_compaction_preserves_the_live_set():
+    index = make_index(coarse_dimensions=8)
+    for product_id in range(1, 201, 3):
+        index.delete(product_id)
+    index.upsert(500, random_vectors(1, 32, seed=4)[0].tolist(), 5.0)
+    query = random_vectors(1, 32, seed=5)[0]
+    before = live_ids(index)
+    results = index.search(query, 20, SearchFilters(max_price=100))
+
+    index.compact()
+
+    assert live_ids(index) == before
+    assert len(index) == len(before)
+    assert index.search(query, 20, SearchFilters(max_price=100)) == results
+    # The rows are renumbered, so updates after a compaction must still find the right row
+    index.delete(500)
+    assert 500 not in live_ids(index)
+
+
+def test_background_compaction():
+    index = make_index()
+    for product_id in range(1, 101):
+        index.delete(product_id)
+    # Compaction runs on a thread once a quarter of the rows are tombstones
+    deadline = time.monotonic() + 10
+    while (index._compacting or index._state.count == 200) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert index._state.count < 200
+    assert live_ids(index) == list(range(101, 201))
+
+
+def test_empty_index_takes_the_dimensions_of_the_first_vector():
+    index = VectorIndex(np.zeros(0), np.zeros((0, 0)), np.zeros(0))
+    assert index.search([1.0, 0.0], 1) == []
+    index.upsert(1, [1.0, 0.0], 1.0)
+    assert index.search([1.0, 0.1], 1)[0][0] == 1
+
+
+def test_recall_leaves_out_the_query_product():
+    index = make_index(count=2000, dimensions=64, coarse_dimensions=8)
+    sampled = index.recall(k=10)
+    fresh = index.recall(random_vectors(100, 64, seed=6), k=10)
+    # With the query's own product counted, the sampled recall would be about 1/k higher
+    assert abs(sampled - fresh) < 0.05
+
+
+def test_query_with_the_wrong_dimensions_is_an_error():
+    index = make_index(dimensions=32)
+    with pytest.raises(ValueError):
+        index.search(random_vectors(1, 16)[0], 10)
+
+
+def test_pages_of_a_two_stage_search_are_consistent():
+    # More products than the shortlist, with few coarse dimensions, so the shortlist is a small part of the catalog
+    index = make_index(count=3 * SHORTLIST_SIZE, dimensions=32, coarse_dimensions=4)
+    query = random_vectors(1, 32, seed=7)[0]
+    everything = [product_id for product_id, _ in index.search(query, 100)]
+    for offset, limit in [(0, 10), (10, 10), (45, 5), (90, 10)]:
+        page = [product_id for product_id, _ in index.search(query, offset + limit)][offset:]
+        assert page == everything[offset:offset + limit]
+
+
+def test_coarse_index_stores_the_full_vectors_as_float16(monkeypatch):
+    # Score a few rows at a time, to go through more than one chunk
+    monkeypatch.setattr(vector_index, "SCORE_CHUNK", 16)
+    index = make_index(coarse_dimensions=8)
+    index.upsert(1000, random_vectors(1, 32, seed=8)[0].tolist(), 1.0)
+    index.compact()
+    _, vectors, _, _ = index.live()
+    assert vectors.dtype == np.float16
+
+    exact = make_index()
+    exact.upsert(1000, random_vectors(1, 32, seed=8)[0].tolist(), 1.0)
+    query = random_vectors(1, 32, seed=9)[0]
+    results = index.search(query, 10, exact=True)
+    expected = exact.search(query, 10)
+    assert [product_id for product_id, _ in results] == [product_id for product_id, _ in expected]
+    assert np.allclose([score for _, score in results], [score for _, score in expected], atol=1e-3)
@@ -0,0 +1,156 @@
+"""
+Lightweight per-stage timing for the HTTP handlers.
+
+Each request gets a `RequestTimer`. Stages are wrapped in `span("name")`, which records
+how long the stage took against the timer for the current request. The backends use the
+same `span()` helper, so their stages show up without having to pass the timer around.
+
+When the request finishes the timer can produce a `Server-Timing` header (visible in the
+browser dev tools) and logs a one-line summary of the stages. The Functions host only forwards the
+text of a log record to Application Insights, so the per-stage durations are also recorded as an
+OpenTelemetry histogram (`request_stage_duration`, with `request` and `stage` attributes). These are
+exported to Application Insights by azure-monitor-opentelemetry, once `configure_telemetry()` has
+been called and if APPLICATIONINSIGHTS_CONNECTION_STRING is set.
+
+Set SLOW_REQUEST_THRESHOLD_MS to log a warning for slow requests. If pyinstrument is installed
+and PROFILE_SLOW_REQUESTS=1, requests are also run under its sampling profiler and the profile
+is logged for the requests that go over the threshold.
+"""
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", 0))
+PROFILE_SLOW_REQUESTS = bool(int(os.getenv("PROFILE_SLOW_REQUESTS", 0)))
+
+# The request_stage_duration histogram, set by configure_telemetry()
+_stage_duration = None
+_telemetry_lock = threading.Lock()
+
+_current_timer: contextvars.ContextVar[Optional["RequestTimer"]] = contextvars.ContextVar("request_timer", default=None)
+
+# Called with (timer, profile_text) when a request goes over SLOW_REQUEST_THRESHOLD_MS
+slow_request_hooks: list[Callable[["RequestTimer", Optional[str]], None]] = []
+
+
+class RequestTimer:
+    def __init__(self, name: str):
+        self.name = name
+        self.stages: list[tuple[str, float]] = []
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self._profiler = None
+        self._token = None
+
+    def __enter__(self) -> "RequestTimer":
+        self._token = _current_timer.set(self)
+        if PROFILE_SLOW_REQUESTS and SLOW_REQUEST_THRESHOLD_MS:
+            self._profiler = _start_profiler()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end = time.perf_counter()
+        _current_timer.reset(self._token)
+        profile = None
+        if self._profiler is not None:
+            self._profiler.stop()
+            if self.is_slow:
+                profile = self._profiler.output_text(unicode=False, color=False)
+        self.log_metrics()
+        if self.is_slow:
+            logging.warning(f"Slow request {self.name}: {self.total_ms:.1f}ms ({self._summary()})")
+            if profile:
+                logging.warning(profile)
+            for hook in slow_request_hooks:
+                hook(self, profile)
+
+    def record(self, stage: str, duration_ms: float):
+        self.stages.append((stage, duration_ms))
+
+    @property
+    def total_ms(self) -> float:
+        end = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+    @property
+    def is_slow(self) -> bool:
+        return bool(SLOW_REQUEST_THRESHOLD_MS) and self.total_ms > SLOW_REQUEST_THRESHOLD_MS
+
+    def server_timing(self) -> str:
+        """
+        Format the stages as a Server-Timing header value, e.g. "embedding;dur=52.1, total;dur=60.3"
+        """
+        entries = [f"{stage};dur={duration:.1f}" for stage, duration in self.stages]
+        entries.append(f"total;dur={self.total_ms:.1f}")
+        return ", ".join(entries)
+
+    def headers(self) -> dict[str, str]:
+        return {"Server-Timing": self.server_timing()}
+
+    def log_metrics(self):
+        logging.info(f"{self.name} timings: {self._summary()}, total={self.total_ms:.1f}ms")
+        if _stage_duration is not None:
+            for stage, duration in [*self.stages, ("total", self.total_ms)]:
+                _stage_duration.record(duration, {"request": self.name, "stage": stage})
+
+    def _summary(self) -> str:
+        return ", ".join(f"{stage}={duration:.1f}ms" for stage, duration in self.stages)
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Time a stage of the current request. Does nothing (apart from timing) outside of a request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer = _current_timer.get()
+        if timer is not None:
+            timer.record(stage, (time.perf_counter() - start) * 1000)
+
+
+def configure_telemetry():
+    """
+    Send the stage durations to Application Insights as metrics. Importing and starting the exporter
+    takes a while, so call this off the request path. Does nothing if APPLICATIONINSIGHTS_CONNECTION_STRING
+    isn't set or if it has already been called.
+    """
+    global _stage_duration
+    with _telemetry_lock:
+        if _stage_duration is not None or not os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+            return
+        try:
+            from azure.monitor.opentelemetry import configure_azure_monitor
+            from opentelemetry import metrics
+        except ImportError:
+            logging.warning("APPLICATIONINSIGHTS_CONNECTION_STRING is set but azure-monitor-opentelemetry is not installed, "
+                            "only the timing summaries are logged")
+            return
+        # The Functions host already sends the log records to Application Insights, so only collect
+        # logs from a logger nothing writes to, otherwise every record would be sent twice
+        configure_azure_monitor(logger_name=f"{__name__}.otel")
+        _stage_duration = metrics.get_meter(__name__).create_histogram(
+            "request_stage_duration", unit="ms", description="Time spent in each stage of a request")
+
+
+def _start_profiler():
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        logging.warning("PROFILE_SLOW_REQUESTS is set but pyinstrument is not installed")
+        return None
+    profiler = Profiler(async_mode="disabled")
+    try:
+        profiler.start()
+    except RuntimeError:
+        # Another profiler is already running on this thread
+        return None
+    return profiler